@@ -14,9 +14,40 @@
 
 # Use this software for good, not for evil.
 
-from copy import deepcopy
+import sys
+import struct
+import threading
+import weakref
+import cPickle as pickle
 
-SENTINEL = object()
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import chain, imap
+from operator import attrgetter, itemgetter
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Fall back to multiprocessing, which is always there on Python 2.
+    ProcessPoolExecutor = None
+
+
+class Sentinel(object):
+    """ Marker for missing items. Its only instance is SENTINEL, which is
+    preserved by pickling. """
+    __slots__ = []
+    def __reduce__(self):
+        return 'SENTINEL'
+    
+    def __repr__(self):
+        return 'SENTINEL'
+
+SENTINEL = Sentinel()
 
 SHIFT = 5
 BMAP = (1 << SHIFT) - 1
@@ -24,18 +55,33 @@ BRANCH = 2 ** SHIFT
 
 MAXBITMAPDISPATCH = 16
 
+# The number of levels it takes until all bits of a hash, which is a C long
+# including its sign bit, have been dispatched on.
+DEPTH = -(-(sys.maxint.bit_length() + 1) // SHIFT)
+SHIFTS = range(0, DEPTH * SHIFT, SHIFT)
+
 def relevant(hsh, shift):
     """ Return the relevant part of the hsh on the level shift. """
     return hsh >> shift & BMAP
 
 
-POPCOUNT_TBL = [0] * (2 ** 16)
-for idx in xrange(2 ** 16):
-    POPCOUNT_TBL[idx] = (idx & 1) + POPCOUNT_TBL[idx >> 1]
+# BITS[n] is the mask of the nth bit, LOWER[n] the mask of all bits below
+# it. Both are used by DispatchNode to avoid shifting on every access.
+BITS = [1 << n for n in xrange(BRANCH)]
+LOWER = [bit - 1 for bit in BITS]
 
-def bit_count(v):
-    return (POPCOUNT_TBL[v & 0xffff] +
-            POPCOUNT_TBL[(v >> 16) & 0xffff])
+if hasattr(int, 'bit_count'):
+    bit_count = int.bit_count
+else:
+    # Doubling the table for every bit is a lot cheaper at import time
+    # than computing the 65536 entries one by one.
+    POPCOUNT_TBL = [0]
+    for _ in xrange(16):
+        POPCOUNT_TBL += [count + 1 for count in POPCOUNT_TBL]
+    
+    def bit_count(v):
+        """ Return the number of bits set in the 32 bit integer v. """
+        return POPCOUNT_TBL[v & 0xffff] + POPCOUNT_TBL[v >> 16 & 0xffff]
 
 
 def doc(docstring):
@@ -55,7 +101,8 @@ ASSOC = "\n".join([
 ])
 
 IASSOC = "\n".join([
-    "Modify so that the AssocNode whose key's hash is hsh is added to it.",
+    "Add the AssocNode whose key's hash is hsh, modifying nodes in place",
+    "where they are owned by edit and copying them otherwise.",
     "USE WITH CAUTION.",
     "shift refers to the current level in the tree, which must be a multiple",
     "of the global constant BRANCH. If a node with the same key already",
@@ -68,6 +115,14 @@ GET = "\n".join([
     "of the global constant BRANCH.",
 ])
 
+FIND = "\n".join([
+    "Return the AssocNode with key whose hash is hsh in the subtree, or",
+    "NULLNODE if there is none. Unlike get, this does not raise KeyError,",
+    "which is a lot cheaper if the key is missing.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
 WITHOUT = "\n".join([
     "Remove AssocNode with key whose hash is hsh from the subtree.",
     "shift refers to the current level in the tree, which must be a multiple",
@@ -75,40 +130,119 @@ WITHOUT = "\n".join([
 ])
 
 IWITHOUT = "\n".join([
-    "Modify so that the AssocNode whose key's hash is hsh is removed from it.",
+    "Remove the AssocNode with key whose hash is hsh, modifying nodes in",
+    "place where they are owned by edit and copying them otherwise.",
     "USE WITH CAUTION.",
     "shift refers to the current level in the tree, which must be a multiple",
     "of the global constant BRANCH.",
 ])
 
+UNION = "\n".join([
+    "Return the union of the subtree and other, the subtree at the same",
+    "position in another tree. If both contain a key, the node in other wins.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
+INTERSECTION = "\n".join([
+    "Return the nodes of the subtree whose keys are also contained in other,",
+    "the subtree at the same position in another tree.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
+DIFFERENCE = "\n".join([
+    "Return the nodes of the subtree whose keys are not contained in other,",
+    "the subtree at the same position in another tree.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
+SYMMETRIC_DIFFERENCE = "\n".join([
+    "Return the nodes of the subtree and of other, the subtree at the same",
+    "position in another tree, whose keys are only contained in one of them.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
+DIFF = "\n".join([
+    "Yield (old, new) pairs of the AssocNodes of other, the subtree at the",
+    "same position in an older tree, and of the subtree whose keys are the",
+    "same but that are different nodes. If a key is only present on one of",
+    "the sides, the other node of the pair is NULLNODE. Subtrees that are the",
+    "same object on both sides are skipped.",
+    "shift refers to the current level in the tree, which must be a multiple",
+    "of the global constant BRANCH.",
+])
+
+def lookupdiff(shift, new, old):
+    """ Implement the diff method of the nodes new and old, which are at
+    the level shift, by looking up every key of each in the other. """
+    if new is old:
+        return
+    for node in new:
+        onode = old.find(node.hsh, shift, node.key)
+        if onode is not node:
+            yield onode, node
+    for onode in old:
+        if new.find(onode.hsh, shift, onode.key) is NULLNODE:
+            yield onode, NULLNODE
+
+
 class NullNode(object):
     """ Dummy node being the leaf of branches that have no entries. """
     __slots__ = []
-    def xor(self, hsh, shift, node):
-        return node    
-    
+    # Every node knows the number of AssocNodes in its subtree.
+    size = 0
     @doc(ASSOC)
     def assoc(self, hsh, shift, node):
         # Because there currently no node, the new node
         # is the node to be added.
         return node
     
-    # The NullNode does not need to be modified if a new association is
-    # created because it only returns the new node, hence _iassoc = assoc.
-    _iassoc = assoc
+    @doc(IASSOC)
+    def _iassoc(self, hsh, shift, node, edit):
+        # The NullNode does not need to be modified if a new association is
+        # created because it only returns the new node.
+        return node
     
     def get(self, hsh, shift, key):
         # There is no entry with the searched key because the hash leads
         # to a branch ending in a NullNode.
         raise KeyError(key)
     
+    @doc(FIND)
+    def find(self, hsh, shift, key):
+        return self
+    
     @doc(WITHOUT)
     def without(self, hsh, shift, key):
         # There is no entry with the key to be removed because the hash leads
         # to a branch ending in a NullNode.
         raise KeyError(key)
     
-    _iwithout = without
+    @doc(IWITHOUT)
+    def _iwithout(self, hsh, shift, key, edit):
+        raise KeyError(key)
+    
+    @doc(UNION)
+    def union(self, shift, other):
+        return other
+    
+    @doc(INTERSECTION)
+    def intersection(self, shift, other):
+        return self
+    
+    difference = intersection
+    
+    @doc(SYMMETRIC_DIFFERENCE)
+    def symmetric_difference(self, shift, other):
+        return other
+    
+    @doc(DIFF)
+    def diff(self, shift, other):
+        for node in other:
+            yield node, NULLNODE
     
     def __iter__(self):
         # There are no keys contained in a NullNode. Hence, an empty
@@ -117,6 +251,10 @@ class NullNode(object):
     
     # Likewise, there are no values and items in a NullNode.
     iteritems = itervalues = __iter__
+    
+    def __reduce__(self):
+        # Unpickle to the existing instance.
+        return 'NULLNODE'
 
 # We only need one instance of a NullNode because it does not contain
 # any data.
@@ -126,15 +264,11 @@ NULLNODE = NullNode()
 class SetNode(object):
     """ A AssocNode contains the actual key-value mapping. """
     __slots__ = ['key', 'hsh']
-    def __init__(self, key):
+    size = 1
+    def __init__(self, key, hsh=None):
+        # The hash may have been computed already, see assoc_hashed.
         self.key = key
-        self.hsh = hash(key)
-    
-    def xor(self, hsh, shift, node):
-        if node.key == self.key:
-            return NULLNODE
-        else:
-            return self.assoc(hsh, shift, node)
+        self.hsh = hash(key) if hsh is None else hsh
     
     @doc(GET)
     def get(self, hsh, shift, key):
@@ -145,6 +279,13 @@ class SetNode(object):
             raise KeyError(key)
         return self
     
+    @doc(FIND)
+    def find(self, hsh, shift, key):
+        # Comparing the hashes first saves calling __eq__ of the keys.
+        if hsh == self.hsh and key == self.key:
+            return self
+        return NULLNODE
+    
     @doc(ASSOC)
     def assoc(self, hsh, shift, node):
         # If there is a hash-collision, return a HashCollisionNode,
@@ -162,17 +303,17 @@ class SetNode(object):
         return DispatchNode.make(shift, [self, node])
     
     @doc(IASSOC)
-    def _iassoc(self, hsh, shift, node):
+    def _iassoc(self, hsh, shift, node, edit):
+        # Leaves are never modified in place, they are cheap enough to
+        # be replaced by the new node.
         if node.key == self.key:
-            self.key = node.key
-            self.value = node.value
-            return self
+            return node
         
         if hsh == self.hsh:
             return HashCollisionNode(
-                [self, node]
+                [self, node], edit
             )
-        return DispatchNode.make(shift, [self, node])        
+        return DispatchNode.make(shift, [self, node], edit)
     
     @doc(WITHOUT)
     def without(self, hsh, shift, key):
@@ -182,557 +323,3733 @@ class SetNode(object):
             raise KeyError(key)
         return NULLNODE
     
-    _iwithout = without
+    @doc(IWITHOUT)
+    def _iwithout(self, hsh, shift, key, edit):
+        return self.without(hsh, shift, key)
+    
+    @doc(UNION)
+    def union(self, shift, other):
+        if other is self or other is NULLNODE:
+            return self
+        # Only add this node to other if it does not already contain the
+        # key, so that other's value wins.
+        if other.find(self.hsh, shift, self.key) is NULLNODE:
+            return other.assoc(self.hsh, shift, self)
+        return other
+    
+    def _isin(self, shift, other):
+        """ Return whether other, the subtree at the given level, contains
+        an entry with the key of this node. """
+        return other.find(self.hsh, shift, self.key) is not NULLNODE
+    
+    @doc(INTERSECTION)
+    def intersection(self, shift, other):
+        if other is self or self._isin(shift, other):
+            return self
+        return NULLNODE
+    
+    @doc(DIFFERENCE)
+    def difference(self, shift, other):
+        if other is self or self._isin(shift, other):
+            return NULLNODE
+        return self
+    
+    @doc(SYMMETRIC_DIFFERENCE)
+    def symmetric_difference(self, shift, other):
+        if other is self:
+            return NULLNODE
+        if other is NULLNODE:
+            return self
+        if self._isin(shift, other):
+            return other.without(self.hsh, shift, self.key)
+        return other.assoc(self.hsh, shift, self)
+    
+    @doc(DIFF)
+    def diff(self, shift, other):
+        return lookupdiff(shift, self, other)
     
     def __iter__(self):
         yield self
+    
+    def __reduce__(self):
+        return SetNode, (self.key,)
 
 
 class AssocNode(SetNode):
     """ A AssocNode contains the actual key-value mapping. """
     __slots__ = ['value']
-    def __init__(self, key, value):
-        SetNode.__init__(self, key)
+    def __init__(self, key, value, hsh=None):
+        SetNode.__init__(self, key, hsh)
         self.value = value
     
+    def __reduce__(self):
+        return AssocNode, (self.key, self.value)
+    
     def __repr__(self):
         return '<AssocNode(%r, %r)>' % (self.key, self.value)
 
 
+# The classes of the nodes that contain the actual entries.
+LEAVES = frozenset([SetNode, AssocNode])
+
+
+# Buckets of HashCollisionNodes with more children than this are kept
+# sorted by key if their keys can be ordered, so that the keys can be
+# found by bisection instead of comparing them with every child.
+MAXLINEARCOLLISION = 8
+
+# The types whose instances can be ordered consistently with equality,
+# mapped to the family of types they can be ordered with.
+ORDERABLE = {int: int, long: int, bool: int, str: str, unicode: unicode}
+
+def orderable(keys):
+    """ Return whether keys can be sorted consistently with equality. """
+    families = set(ORDERABLE.get(key.__class__) for key in keys)
+    return len(families) == 1 and None not in families
+
+
 class HashCollisionNode(object):
     """ If hashes of two keys collide, store them in a list and when a key
-    is searched, iterate over that list and find the appropriate key. """
-    __slots__ = ['children']
-    def __init__(self, nodes):
+    is searched, iterate over that list and find the appropriate key.
+    
+    As keys may be chosen to collide on purpose, buckets with more than
+    MAXLINEARCOLLISION children whose keys are orderable are kept sorted,
+    with keys being the sorted list of their keys, so keys of the same
+    family are found in logarithmic time. For all other buckets, keys is
+    None. """
+    __slots__ = ['children', 'hsh', 'edit', 'keys']
+    def __init__(self, nodes, edit=None, keys=None):
         self.children = nodes
-        self.hsh = hash(nodes[0].hsh)
-
-    def xor(self, hsh, shift, node):
-        if not any(node.key == child.key for child in self.children):
-            return HashCollisionNode(self.children + [node])
-        return self    
+        self.hsh = nodes[0].hsh
+        self.edit = edit
+        self.keys = keys
+        if keys is None:
+            self._order()
     
-    @doc(GET)
-    def get(self, hsh, shift, key):
-        # To get the child we want we need to iterate over all possible ones.
+    def _order(self):
+        """ Sort the children if the bucket should be sorted, otherwise
+        mark it as unsorted.
+        
+        USE WITH CAUTION. """
+        children = self.children
+        if (len(children) > MAXLINEARCOLLISION and
+            orderable(node.key for node in children)):
+            children.sort(key=attrgetter('key'))
+            self.keys = [node.key for node in children]
+        else:
+            self.keys = None
+    
+    @property
+    def size(self):
+        return len(self.children)
+    
+    def __reduce__(self):
+        return HashCollisionNode, (self.children,)
+    
+    def _editable(self, edit):
+        """ Return self if it is owned by edit, otherwise a copy of self
+        that is. Persistent nodes have no owner, so None always gets a
+        copy. """
+        if edit is not None and self.edit is edit:
+            return self
+        keys = self.keys
+        return HashCollisionNode(
+            self.children[:], edit, None if keys is None else keys[:]
+        )
+    
+    def _sorted(self, key):
+        """ Return whether the bucket is sorted and key can be ordered with
+        its keys. """
+        keys = self.keys
+        return keys is not None and (
+            ORDERABLE.get(key.__class__) is ORDERABLE[keys[0].__class__]
+        )
+    
+    def _index(self, key):
+        """ Return the index of the child with key and True, or the index
+        key would have to be inserted at and False if there is none. """
+        if self._sorted(key):
+            keys = self.keys
+            idx = bisect_left(keys, key)
+            return idx, idx < len(keys) and keys[idx] == key
         # The contents of children are always AssocNodes,
         # so we can safely access the key member.
-        for node in self.children:
+        for idx, node in enumerate(self.children):
             if key == node.key:
-                return node
-        raise KeyError(key)
+                return idx, True
+        return len(self.children), False
+
+    @doc(GET)
+    def get(self, hsh, shift, key):
+        idx, found = self._index(key)
+        if not found:
+            raise KeyError(key)
+        return self.children[idx]
+    
+    @doc(FIND)
+    def find(self, hsh, shift, key):
+        if hsh == self.hsh:
+            idx, found = self._index(key)
+            if found:
+                return self.children[idx]
+        return NULLNODE
     
     @doc(ASSOC)
     def assoc(self, hsh, shift, node):
         # If we have yet another key with a colliding key, return a new node
-        # with it added to the children, otherwise return a DispatchNode.
+        # with it added to the children (replacing a child with the same
+        # key), otherwise return a DispatchNode.
         if hsh == self.hsh:
-            return HashCollisionNode(self.children + [node])
+            key = node.key
+            idx, found = self._index(key)
+            children = self.children[:]
+            if found:
+                children[idx] = node
+                # The keys are only read, so they can be shared.
+                return HashCollisionNode(children, None, self.keys)
+            if self._sorted(key):
+                keys = self.keys[:]
+                keys.insert(idx, key)
+                children.insert(idx, node)
+                return HashCollisionNode(children, None, keys)
+            children.append(node)
+            return HashCollisionNode(children)
         return DispatchNode.make(shift, [self, node])
     
     @doc(IASSOC)
-    def _iassoc(self, hsh, shift, node):
+    def _iassoc(self, hsh, shift, node, edit):
         # If we have yet another key with a colliding key, add it to the
         # children, otherwise return a DispatchNode.
         if hsh == self.hsh:
-            self.children.append(node)
-            return self
-        return DispatchNode.make(shift, [self, node])        
+            editable = self._editable(edit)
+            key = node.key
+            idx, found = editable._index(key)
+            if found:
+                editable.children[idx] = node
+            elif editable._sorted(key):
+                editable.keys.insert(idx, key)
+                editable.children.insert(idx, node)
+            else:
+                editable.children.append(node)
+                editable._order()
+            return editable
+        return DispatchNode.make(shift, [self, node], edit)
     
     @doc(WITHOUT)
     def without(self, hsh, shift, key):
         # Remove the node whose key is key from the children. If it was the
         # last child, return NULLNODE. If there was no member with a
         # matching key, raise KeyError.
-        newchildren = [node for node in self.children if node.key != key]
-        if not newchildren:
-            return NULLNODE
-        
-        if newchildren == self.children:
+        idx, found = self._index(key)
+        if not found:
             raise KeyError(key)
+        if len(self.children) == 1:
+            return NULLNODE
         
-        return HashCollisionNode(newchildren)
+        children = self.children[:]
+        del children[idx]
+        keys = self.keys
+        if keys is not None:
+            keys = keys[:]
+            del keys[idx]
+        return HashCollisionNode(children, None, keys)
     
     @doc(IWITHOUT)
-    def _iwithout(self, hsh, shift, key):
-        newchildren = [node for node in self.children if node.key != key]
-        if not newchildren:
-            return NULLNODE
-        
-        if newchildren == self.children:
+    def _iwithout(self, hsh, shift, key, edit):
+        idx, found = self._index(key)
+        if not found:
             raise KeyError(key)
+        if len(self.children) == 1:
+            return NULLNODE
         
-        self.children = newchildren
-        return self
+        editable = self._editable(edit)
+        del editable.children[idx]
+        if editable.keys is not None:
+            del editable.keys[idx]
+        return editable
     
-    def __iter__(self):
+    @doc(UNION)
+    def union(self, shift, other):
+        if other is self or other is NULLNODE:
+            return self
+        new = other
         for node in self.children:
-            for elem in node:
-                yield elem
-
-
-class ListDispatch(object):
-    """ Light weight dictionary like object for a little amount of items.
-    Only feasable for a little amount of items as a list of length nitems 
-    is always stored.
-    
-    Only accepts integers as keys. """
-    __slots__ = ['items']
+            new = node.union(shift, new)
+        return new
     
-    def __init__(self, nitems=None, items=None):
-        if items is None:
-            items = [SENTINEL for _ in xrange(nitems)]
-        self.items = items
+    def _filtered(self, nodes):
+        """ Return the node containing nodes, a subset of the children. """
+        if not nodes:
+            return NULLNODE
+        if len(nodes) == 1:
+            return nodes[0]
+        if len(nodes) == len(self.children):
+            return self
+        return HashCollisionNode(nodes)
     
-    def replace(self, key, item):
-        """ Return a new ListDispatch with the the keyth item replaced
-        with item. """
-        return ListDispatch(
-            None,
-            self.items[:key] +
-            [item] +
-            self.items[key + 1:]
+    @doc(INTERSECTION)
+    def intersection(self, shift, other):
+        if other is self:
+            return self
+        return self._filtered(
+            [node for node in self.children if node._isin(shift, other)]
         )
     
-    def _ireplace(self, key, item):
-        """ Replace keyth item with item.
-        
-        USE WITH CAUTION. """
-        self.items[key] = item
-        return self
-    
-    def __getitem__(self, key):
-        value = self.items[key]
-        if value is SENTINEL:
-            raise KeyError(key)
-        return value
-    
-    def get(self, key, default):
-        """ Get keyth item. If it is not present, return default. """
-        value = self.items[key]
-        if value is not SENTINEL:
-            return value
-        return default
+    @doc(DIFFERENCE)
+    def difference(self, shift, other):
+        if other is self:
+            return NULLNODE
+        return self._filtered(
+            [node for node in self.children if not node._isin(shift, other)]
+        )
     
-    def remove(self, key):
-        """ Return new ListDispatch with keyth item removed.
-        Will not raise KeyError if it was not present. """        
-        return self.replace(key, SENTINEL)
-
-    def _iremove(self, key):
-        """ Remove keyth item. Will not raise KeyError if it was not present.
-        
-        USE WITH CAUTION. """
-        self._ireplace(key, SENTINEL)
-        return self
+    @doc(SYMMETRIC_DIFFERENCE)
+    def symmetric_difference(self, shift, other):
+        if other is self:
+            return NULLNODE
+        if other is NULLNODE:
+            return self
+        new = other
+        for node in self.children:
+            new = node.symmetric_difference(shift, new)
+        return new
     
-    def to_bitmapdispatch(self):
-        dispatch = BitMapDispatch()
-        for key, value in enumerate(self.items):
-            if value is not SENTINEL:
-                dispatch._ireplace(key, value)
-        return dispatch
+    @doc(DIFF)
+    def diff(self, shift, other):
+        return lookupdiff(shift, self, other)
     
     def __iter__(self):
-        return (item for item in self.items if item is not SENTINEL)
+        return iter(self.children)
+
 
+# A DispatchNode whose items become dense once it has more than
+# MAXBITMAPDISPATCH children switches back to the sparse layout once it
+# shrinks to this many children. This is lower than MAXBITMAPDISPATCH so
+# that a node does not switch back and forth when keys around the limit
+# are added and removed alternately.
+MINLISTDISPATCH = MAXBITMAPDISPATCH // 2
 
-class BitMapDispatch(object):
-    """ Light weight dictionary like object for a little amount of items.
-    Best used for as most as many items as an integer has bits (usually 32).
-    Only accepts integers as keys.
+
+class DispatchNode(object):
+    """ Dispatch to children nodes depending of the hsh value at the
+    current level.
     
-    The items are stored in a list and whenever an item is added, the bitmap
-    is ORed with (1 << key) so that the keyth bit is set.
-    The amount of set bits before the nth bit is used to find the index of the
-    item referred to by key in the items list.
-    """
-    __slots__ = ['bitmap', 'items']
-    def __init__(self, bitmap=0, items=None):
+    The children are stored directly in the list items, without a separate
+    dispatch object. While there are at most MAXBITMAPDISPATCH of them,
+    items only contains the occupied slots, and the index of a slot is the
+    number of bits set below it in bitmap. Once the node is dense, items
+    has one entry per slot, NULLNODE for unoccupied ones, and the slot is
+    the index. Both layouts are
+    told apart by the length of items, which is BRANCH only in the dense
+    one (or if every slot is occupied, where the two coincide). """
+    __slots__ = ['bitmap', 'items', 'edit', 'size']
+    def __init__(self, bitmap=0, items=None, edit=None, size=0):
         if items is None:
             items = []
+        
         self.bitmap = bitmap
         self.items = items
+        # Nodes may only be modified in place by the VolatileTreeMap whose
+        # edit token they carry. Persistent nodes have None.
+        self.edit = edit
+        # The number of AssocNodes in the subtree. It is maintained by
+        # looking at the size of the child that was replaced and the one
+        # replacing it, so no operation needs to know whether it added or
+        # overrode a key.
+        self.size = size
     
-    def replace(self, key, item):
-        """ Return a new BitMapDispatch with the the keyth item replaced
-        with item. """
-        # If the item already existed in the list, we need to replace it.
-        # Otherwise, it will be added to the list at the appropriate
-        # position.
-        notnew = bool(self.bitmap & 1 << key)
-        newmap = self.bitmap | 1 << key
-        idx = bit_count(self.bitmap & ((1 << key) - 1))
-        return BitMapDispatch(
-            newmap,
-            # If notnew is True, the item that is replaced by the new item
-            # is left out, otherwise the new item is inserted. Refer to
-            # _ireplace for a more concise explanation.
-            self.items[:idx] + [item] + self.items[idx+notnew:]
-        )
-    
-    def _ireplace(self, key, item):
-        """ Replace keyth item with item.
-        
-        USE WITH CAUTION. """
-        notnew = bool(self.bitmap & 1 << key)
-        self.bitmap |= 1 << key
-        idx = bit_count(self.bitmap & ((1 << key) - 1))
-        if idx == len(self.items):
-            self.items.append(item)
-        elif notnew:
-            self.items[idx] = item
-        else:
-            self.items.insert(idx, item)
-        
-        return self
+    @staticmethod
+    def layout(bitmap, children):
+        """ Return the items for a DispatchNode whose children, ordered by
+        their slot, occupy the slots set in bitmap. """
+        if len(children) <= MAXBITMAPDISPATCH:
+            return children
+        items = [NULLNODE] * BRANCH
+        for child in children:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            items[bit.bit_length() - 1] = child
+        return items
     
-    def get(self, key, default=None):
-        """ Get keyth item. If it is not present, return default. """
-        if not self.bitmap & 1 << key:
-            return default
-        return self.items[bit_count(self.bitmap & ((1 << key) - 1))]
+    def child(self, rlv):
+        """ Return the child in slot rlv, or NULLNODE if it is empty. """
+        items = self.items
+        if len(items) == BRANCH:
+            return items[rlv]
+        bitmap = self.bitmap
+        if not bitmap & BITS[rlv]:
+            return NULLNODE
+        return items[bit_count(bitmap & LOWER[rlv])]
     
-    def remove(self, key):
-        """ Return new BitMapDispatch with keyth item removed.
-        Will not raise KeyError if it was not present. """
-        idx = bit_count(self.bitmap & ((1 << key) - 1))
-        return BitMapDispatch(
-            # Unset the keyth bit.
-            self.bitmap & ~(1 << key),
-            # Leave out the idxth item.
-            self.items[:idx] + self.items[idx+1:]
-        )
+    def iterchildren(self):
+        """ Return iterator over the children ordered by their slot. """
+        if len(self.items) == BRANCH:
+            return (child for child in self.items if child is not NULLNODE)
+        return iter(self.items)
     
-    def _iremove(self, key):
-        """ Remove keyth item. Will not raise KeyError if it was not present.
+    def _put(self, rlv, child):
+        """ Put child into slot rlv, switching to the dense layout if the
+        node becomes dense.
         
         USE WITH CAUTION. """
-        idx = bit_count(self.bitmap & ((1 << key) - 1))
-        self.bitmap &= ~(1 << key)
-        self.items.pop(idx)
-        return self
-    
-    def __getitem__(self, key):
-        if not self.bitmap & 1 << key:
-            raise KeyError(key)
-        return self.items[bit_count(self.bitmap & ((1 << key) - 1))]
-    
-    def to_listdispatch(self, nitems):
-        """ Return ListDispatch with the same key to value connections as this
-        BitMapDispatch. """
-        return ListDispatch(
-            None, [self.get(n, SENTINEL) for n in xrange(nitems)]
-        )
-    
-    def __iter__(self):
-        return iter(self.items)
+        bitmap = self.bitmap
+        items = self.items
+        bit = BITS[rlv]
+        if len(items) == BRANCH:
+            items[rlv] = child
+        elif bitmap & bit:
+            items[bit_count(bitmap & LOWER[rlv])] = child
+        else:
+            items.insert(bit_count(bitmap & LOWER[rlv]), child)
+            if len(items) > MAXBITMAPDISPATCH:
+                self.items = self.layout(bitmap | bit, items)
+        self.bitmap = bitmap | bit
     
-    def __nonzero__(self):
-        return bool(self.items)
-
-
-class DispatchNode(object):
-    """ Dispatch to children nodes depending of the hsh value at the
-    current level. """
-    __slots__ = ['children']
-    def __init__(self, children=None):
-        if children is None:
-            children = BitMapDispatch()
+    def _pop(self, rlv):
+        """ Empty slot rlv, switching to the sparse layout if the node
+        has become sparse.
         
-        self.children = children
-    
-    def xor(self, hsh, shift, node):
-        rlv = relevant(hsh, shift)
-        newchild = self.children.get(rlv, NULLNODE).xor(hsh, shift + SHIFT, node)
-        if newchild is NULLNODE:
-            # This makes sure no dead nodes remain in the tree after
-            # removing an item.
-            newchildren = self.children.remove(rlv)
-            if not newchildren:
-                return NULLNODE
+        USE WITH CAUTION. """
+        bitmap = self.bitmap
+        items = self.items
+        bit = BITS[rlv]
+        if not bitmap & bit:
+            return
+        self.bitmap = bitmap ^ bit
+        if len(items) == BRANCH:
+            items[rlv] = NULLNODE
+            if bit_count(self.bitmap) <= MINLISTDISPATCH:
+                self.items = [item for item in items if item is not NULLNODE]
         else:
-            newchildren = self.children.replace(
-                rlv, 
-                newchild
-            )
-        
-        return DispatchNode(newchildren)
+            del items[bit_count(bitmap & LOWER[rlv])]
+    
+    def _editable(self, edit):
+        """ Return self if it is owned by edit, otherwise a copy of self
+        that is. Persistent nodes have no owner, so None always gets a
+        copy. """
+        if edit is not None and self.edit is edit:
+            return self
+        return DispatchNode(self.bitmap, self.items[:], edit, self.size)
     
     @doc(ASSOC)
     def assoc(self, hsh, shift, node):
         # We need not check whether the return value of
-        # self.children.get(...).assoc is NULLNODE, because assoc never
+        # self.child(...).assoc is NULLNODE, because assoc never
         # returns NULLNODE.
         rlv = relevant(hsh, shift)
-        return DispatchNode(
-            self.children.replace(
-                rlv,
-                self.children.get(rlv, NULLNODE).assoc(
-                    hsh, shift + SHIFT, node
-                )
-            )
+        child = self.child(rlv)
+        newchild = child.assoc(hsh, shift + SHIFT, node)
+        new = DispatchNode(
+            self.bitmap, self.items[:], None,
+            self.size - child.size + newchild.size
         )
+        new._put(rlv, newchild)
+        return new
     
     @doc(IASSOC)
-    def _iassoc(self, hsh, shift, node):
+    def _iassoc(self, hsh, shift, node, edit):
         rlv = relevant(hsh, shift)
-        self.children = self.children._ireplace(
-            rlv, 
-            self.children.get(rlv, NULLNODE)._iassoc(hsh, shift + SHIFT, node)
-        )
-        return self
+        child = self.child(rlv)
+        # The child may be modified in place, so remember its size.
+        size = child.size
+        newchild = child._iassoc(hsh, shift + SHIFT, node, edit)
+        if newchild is child:
+            # The child was owned by edit and has been modified in place,
+            # so only the size is left to update on this level.
+            self.size += newchild.size - size
+            return self
+        editable = self._editable(edit)
+        editable._put(rlv, newchild)
+        editable.size += newchild.size - size
+        return editable
     
     @classmethod
-    def make(cls, shift, many):
-        # Because the object we create in this function is not yet exposed
-        # to any other code, we may safely call _iassoc.
-        dsp = cls()
-        for elem in many:
-            dsp._iassoc(elem.hsh, shift, elem)
-        return dsp
-    
+    def make(cls, shift, many, edit=None):
+        """ Create DispatchNode containing the nodes in many, which must
+        have different hashes. """
+        return cls.build(shift, many, edit)
+
+    @classmethod
+    def build(cls, shift, nodes, edit=None):
+        """ Return the node containing all of the given AssocNodes, which
+        must agree in all parts of their hashes below shift. Unlike make,
+        this does not insert the nodes one by one but groups them by the
+        relevant part of their hash and creates every DispatchNode with
+        its final bitmap and items at once. If nodes contains the same key
+        more than once, the last one wins. The new nodes are owned by
+        edit. """
+        if len(nodes) == 1:
+            return nodes[0]
+
+        buckets = {}
+        for node in nodes:
+            rlv = node.hsh >> shift & BMAP
+            try:
+                buckets[rlv].append(node)
+            except KeyError:
+                buckets[rlv] = [node]
+
+        if len(buckets) == 1:
+            # Either all hashes are equal, in which case we will never be
+            # able to tell the nodes apart by dispatching, or they only
+            # differ on a lower level.
+            hsh = nodes[0].hsh
+            if all(node.hsh == hsh for node in nodes):
+                unique = {}
+                for node in nodes:
+                    unique[node.key] = node
+                if len(unique) == 1:
+                    return nodes[-1]
+                # Preserve the order in which the keys first occurred.
+                return HashCollisionNode(
+                    [unique.pop(node.key) for node in nodes
+                     if node.key in unique],
+                    edit
+                )
+
+        bitmap = 0
+        size = 0
+        items = []
+        for rlv in sorted(buckets):
+            bitmap |= 1 << rlv
+            bucket = buckets[rlv]
+            if len(bucket) == 1:
+                # Save the function call for the common case.
+                items.append(bucket[0])
+            else:
+                items.append(cls.build(shift + SHIFT, bucket, edit))
+            size += items[-1].size
+        return cls(bitmap, cls.layout(bitmap, items), edit, size)
+
     @doc(GET)
     def get(self, hsh, shift, key):
-        return self.children.get(relevant(hsh, shift), NULLNODE).get(
-            hsh, shift + SHIFT, key
-        )
+        # Walk down the DispatchNodes in a loop instead of calling get on
+        # every level, only the node we end up at is asked for the key.
+        node = self
+        while isinstance(node, DispatchNode):
+            items = node.items
+            rlv = hsh >> shift & BMAP
+            if len(items) == BRANCH:
+                # Empty slots contain NULLNODE, which raises the KeyError.
+                node = items[rlv]
+            else:
+                bitmap = node.bitmap
+                if not bitmap & BITS[rlv]:
+                    raise KeyError(key)
+                node = items[bit_count(bitmap & LOWER[rlv])]
+            shift += SHIFT
+        return node.get(hsh, shift, key)
+    
+    @doc(FIND)
+    def find(self, hsh, shift, key):
+        node = self
+        while isinstance(node, DispatchNode):
+            items = node.items
+            rlv = hsh >> shift & BMAP
+            if len(items) == BRANCH:
+                node = items[rlv]
+            else:
+                bitmap = node.bitmap
+                if not bitmap & BITS[rlv]:
+                    return NULLNODE
+                node = items[bit_count(bitmap & LOWER[rlv])]
+            shift += SHIFT
+        return node.find(hsh, shift, key)
     
     @doc(WITHOUT)
     def without(self, hsh, shift, key):
         rlv = relevant(hsh, shift)
-        newchild = self.children[rlv].without(hsh, shift + SHIFT, key)
-        if newchild is NULLNODE:
+        child = self.child(rlv)
+        newchild = child.without(hsh, shift + SHIFT, key)
+        if newchild is NULLNODE and self.size == child.size:
             # This makes sure no dead nodes remain in the tree after
             # removing an item.
-            newchildren = self.children.remove(rlv)
-            if not newchildren:
-                return NULLNODE
+            return NULLNODE
+        
+        new = DispatchNode(
+            self.bitmap, self.items[:], None,
+            self.size - child.size + newchild.size
+        )
+        if newchild is NULLNODE:
+            new._pop(rlv)
         else:
-            newchildren = self.children.replace(
-                rlv, 
-                newchild
+            new._put(rlv, newchild)
+        return new
+    
+    @doc(UNION)
+    def union(self, shift, other):
+        if other is self or other is NULLNODE:
+            return self
+        if not isinstance(other, DispatchNode):
+            # other is a single AssocNode or a HashCollisionNode.
+            new = self
+            for node in other:
+                new = new.assoc(node.hsh, shift, node)
+            return new
+        
+        return self._combine(
+            shift, other, self.bitmap | other.bitmap, 'union'
+        )
+    
+    @doc(INTERSECTION)
+    def intersection(self, shift, other):
+        if other is self:
+            return self
+        if not isinstance(other, DispatchNode):
+            # Only the keys of the few nodes in other can be contained in
+            # the result.
+            nodes = [
+                node for node in (
+                    self.find(node.hsh, shift, node.key) for node in other
+                ) if node is not NULLNODE
+            ]
+            if not nodes:
+                return NULLNODE
+            return DispatchNode.build(shift, nodes)
+        # Slots that are only occupied in one of the nodes cannot contain
+        # any keys of the intersection.
+        return self._combine(
+            shift, other, self.bitmap & other.bitmap, 'intersection'
+        )
+    
+    @doc(DIFFERENCE)
+    def difference(self, shift, other):
+        if other is self:
+            return NULLNODE
+        if not isinstance(other, DispatchNode):
+            new = self
+            for node in other:
+                try:
+                    new = new.without(node.hsh, shift, node.key)
+                except KeyError:
+                    pass
+            return new
+        return self._combine(shift, other, self.bitmap, 'difference')
+    
+    @doc(SYMMETRIC_DIFFERENCE)
+    def symmetric_difference(self, shift, other):
+        if other is self:
+            return NULLNODE
+        if not isinstance(other, DispatchNode):
+            return other.symmetric_difference(shift, self)
+        return self._combine(
+            shift, other, self.bitmap | other.bitmap, 'symmetric_difference'
+        )
+    
+    @doc(DIFF)
+    def diff(self, shift, other):
+        if other is self:
+            return
+        if not isinstance(other, DispatchNode):
+            for pair in lookupdiff(shift, self, other):
+                yield pair
+            return
+        
+        bitmap = self.bitmap | other.bitmap
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            rlv = bit.bit_length() - 1
+            child = self.child(rlv)
+            ochild = other.child(rlv)
+            # Unchanged subtrees are shared between versions.
+            if child is not ochild:
+                for pair in child.diff(shift + SHIFT, ochild):
+                    yield pair
+    
+    def _replaced(self, children):
+        """ Return the node whose children are children, which replace the
+        children of self in the order of iterchildren. NULLNODE removes a
+        child. If no child was replaced, return self. """
+        if all(a is b for a, b in zip(self.iterchildren(), children)):
+            return self
+        bitmap = self.bitmap
+        newbitmap = 0
+        size = 0
+        items = []
+        for child in children:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            if child is not NULLNODE:
+                newbitmap |= bit
+                size += child.size
+                items.append(child)
+        if not items:
+            return NULLNODE
+        return DispatchNode(
+            newbitmap, self.layout(newbitmap, items), None, size
+        )
+    
+    def _combine(self, shift, other, bitmap, operation):
+        """ Return the node whose children are the result of calling the
+        method operation of the children of self with the children of the
+        DispatchNode other in all slots set in bitmap. Unoccupied slots are
+        represented by NULLNODE, so children that are only present in one
+        of the nodes are reused as they are. """
+        newbitmap = 0
+        size = 0
+        items = []
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            rlv = bit.bit_length() - 1
+            child = getattr(self.child(rlv), operation)(
+                shift + SHIFT, other.child(rlv)
             )
+            if child is not NULLNODE:
+                newbitmap |= bit
+                size += child.size
+                items.append(child)
         
-        return DispatchNode(newchildren)
+        if not items:
+            return NULLNODE
+        # If the result equals either of the nodes, return that one so
+        # it can be shared.
+        for node in (self, other):
+            if node.bitmap == newbitmap and all(
+                a is b for a, b in zip(node.iterchildren(), items)):
+                return node
+        return DispatchNode(
+            newbitmap, self.layout(newbitmap, items), None, size
+        )
     
     @doc(IWITHOUT)
-    def _iwithout(self, hsh, shift, key):
+    def _iwithout(self, hsh, shift, key, edit):
         rlv = relevant(hsh, shift)
-        newchild = self.children[rlv].without(hsh, shift + SHIFT, key)
+        child = self.child(rlv)
+        size = child.size
+        newchild = child._iwithout(hsh, shift + SHIFT, key, edit)
+        if newchild is child:
+            self.size += newchild.size - size
+            return self
+        if newchild is NULLNODE and self.size == size:
+            # The node would become empty, there is no point in copying it.
+            return NULLNODE
+        
+        editable = self._editable(edit)
         if newchild is NULLNODE:
-            self.children = self.children._iremove(rlv)
-            if not newchildren:
-                return NULLNODE
+            editable._pop(rlv)
         else:
-            self.children = self.children._ireplace(rlv, newchild)
-        
-        return self
+            editable._put(rlv, newchild)
+        editable.size += newchild.size - size
+        return editable
     
     def __iter__(self):
-        for child in self.children:
-            for elem in child:
-                yield elem
+        return chain.from_iterable(self.chunks())
+    
+    def chunks(self):
+        """ Yield lists of AssocNodes that together contain all AssocNodes
+        of the subtree. The tree is walked with an explicit stack, so
+        iterating over the result of this only resumes a generator once
+        per DispatchNode instead of once per level and AssocNode. """
+        stack = [self]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            items = pop().items
+            # Comparing the classes is a lot cheaper than isinstance.
+            leaves = [child for child in items if child.__class__ in LEAVES]
+            if len(leaves) != len(items):
+                for child in items:
+                    if child.__class__ in LEAVES or child is NULLNODE:
+                        continue
+                    elif isinstance(child, DispatchNode):
+                        push(child)
+                    elif isinstance(child, HashCollisionNode):
+                        leaves.extend(child.children)
+                    else:
+                        leaves.append(child)
+            yield leaves
+    
+    def __reduce__(self):
+        # The edit token is not pickled, the copy is always persistent.
+        return DispatchNode, (self.bitmap, self.items, None, self.size)
 
 
-class PersistentTreeMap(object):
-    __slots__ = ['root']
-    def __init__(self, root=NULLNODE):
-        self.root = root
+class MappedDispatchNode(DispatchNode):
+    """ DispatchNode read by a NodeReader. Its bitmap and items are only
+    read when they are first accessed. """
+    __slots__ = ['reader', 'offset']
+    def __init__(self, reader, offset, size):
+        # The bitmap and items slots are deliberately left empty, so that
+        # accessing them goes through __getattr__.
+        self.reader = reader
+        self.offset = offset
+        self.edit = None
+        self.size = size
     
-    def __getitem__(self, key):
-        return self.root.get(hash(key), 0, key).value
+    def __getattr__(self, name):
+        if name not in ('bitmap', 'items'):
+            raise AttributeError(name)
+        self.bitmap, self.items = self.reader.children(self.offset)
+        return getattr(self, name)
+
+
+class NodeWriter(object):
+    """ Write trees to a file object in the binary format read by
+    NodeReader. Every node is stored as a record starting with a type
+    character, children are written before their parents and are referred
+    to by their offset in the file:
     
-    def __and__(self, other):
-        new = self.root
-        
-        one = iter(self.root)
-        other = iter(other.root)
-        
-        for node in one:
-            while True:
-                try:
-                    onode = other.next()
-                except StopIteration:
-                    return PersistentTreeMap(new)
-                
-                if onode.hsh == node.hsh:
-                    new = new.assoc(onode.hsh, 0, onode)
-                    break
-                elif onode.hsh > node.hsh:
-                    new = new.without(node.hsh, 0, node.key)
-                    break
-        
-        return PersistentTreeMap(new)
+    'D' bitmap (uint32) size (uint64) types of the children (char)
+        offsets of the children (uint64) sizes of the children (uint64)
+    'C' number of children (uint32) offsets of the children (uint64)
+    'A' hash (int64) length (uint32) pickle of (key, value)
+    'S' hash (int64) length (uint32) pickle of key
+    'N'
+    
+    The file starts with MAGIC and ends with the offset of the root node.
+    All integers are little-endian. Because the hashes are stored, the keys
+    must hash to the same values when the file is read.
+    
+    The parent records contain the types and sizes of their children so
+    that children which are DispatchNodes can be created without touching
+    the pages they are stored in. """
+    MAGIC = 'PDICT\x00\x00\x01'
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+    
+    def _record(self, data):
+        offset = self.offset
+        self.fileobj.write(data)
+        self.offset += len(data)
+        return offset
+    
+    def write(self, node):
+        """ Write node and its subtree and return its offset. """
+        if isinstance(node, DispatchNode):
+            children = list(node.iterchildren())
+            offsets = [self.write(child) for child in children]
+            return self._record(
+                struct.pack('<cIQ', 'D', node.bitmap, node.size) +
+                ''.join(
+                    'D' if isinstance(child, DispatchNode) else '?'
+                    for child in children
+                ) +
+                struct.pack(
+                    '<%dQ' % (2 * len(children)),
+                    *(offsets + [child.size for child in children])
+                )
+            )
+        elif isinstance(node, HashCollisionNode):
+            offsets = [self.write(child) for child in node.children]
+            return self._record(
+                struct.pack(
+                    '<cI%dQ' % len(offsets), 'C', len(offsets), *offsets
+                )
+            )
+        elif isinstance(node, AssocNode):
+            payload = pickle.dumps((node.key, node.value), 2)
+            return self._record(
+                struct.pack('<cqI', 'A', node.hsh, len(payload)) + payload
+            )
+        elif isinstance(node, SetNode):
+            payload = pickle.dumps(node.key, 2)
+            return self._record(
+                struct.pack('<cqI', 'S', node.hsh, len(payload)) + payload
+            )
+        elif node is NULLNODE:
+            return self._record('N')
+        raise TypeError('Cannot write %r.' % node)
+    
+    def dump(self, root):
+        """ Write the tree whose root node is root. """
+        self._record(self.MAGIC)
+        self._record(struct.pack('<Q', self.write(root)))
+
+
+class NodeReader(object):
+    """ Read trees written by a NodeWriter from a buffer, usually an mmap.
+    DispatchNodes are only read once their children are accessed. """
+    def __init__(self, buf):
+        if buf[:len(NodeWriter.MAGIC)] != NodeWriter.MAGIC:
+            raise ValueError('Not a tree file.')
+        self.buf = buf
+    
+    @classmethod
+    def open(cls, path):
+        """ Return NodeReader for the file at path, which is memory mapped
+        if possible. """
+        with open(path, 'rb') as fileobj:
+            if mmap is None:
+                return cls(fileobj.read())
+            return cls(
+                mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+    
+    def root(self):
+        """ Return the root node. """
+        return self.node(
+            struct.unpack_from('<Q', self.buf, len(self.buf) - 8)[0]
+        )
+    
+    def node(self, offset):
+        """ Return the node stored at offset. """
+        kind = self.buf[offset]
+        if kind == 'D':
+            size, = struct.unpack_from('<Q', self.buf, offset + 5)
+            return MappedDispatchNode(self, offset, size)
+        elif kind == 'C':
+            nitems, = struct.unpack_from('<I', self.buf, offset + 1)
+            return HashCollisionNode(
+                [self.node(child) for child in
+                 struct.unpack_from('<%dQ' % nitems, self.buf, offset + 5)]
+            )
+        elif kind in ('A', 'S'):
+            hsh, length = struct.unpack_from('<qI', self.buf, offset + 1)
+            payload = pickle.loads(self.buf[offset + 13:offset + 13 + length])
+            if kind == 'A':
+                node = AssocNode(*payload)
+            else:
+                node = SetNode(payload)
+            if node.hsh != hsh:
+                raise ValueError(
+                    'Hash of %r differs from the one it was written '
+                    'with.' % (node.key,)
+                )
+            return node
+        elif kind == 'N':
+            return NULLNODE
+        raise ValueError('Invalid node at offset %d.' % offset)
+    
+    def children(self, offset):
+        """ Return bitmap and items of the DispatchNode stored at offset. """
+        bitmap, = struct.unpack_from('<I', self.buf, offset + 1)
+        nitems = bit_count(bitmap)
+        kinds = self.buf[offset + 13:offset + 13 + nitems]
+        offsets = struct.unpack_from(
+            '<%dQ' % (2 * nitems), self.buf, offset + 13 + nitems
+        )
+        items = []
+        for idx, kind in enumerate(kinds):
+            if kind == 'D':
+                items.append(
+                    MappedDispatchNode(
+                        self, offsets[idx], offsets[nitems + idx]
+                    )
+                )
+            else:
+                items.append(self.node(offsets[idx]))
+        return bitmap, DispatchNode.layout(bitmap, items)
+
+
+def hashpath(hsh):
+    """ Return the slots the hash hsh dispatches to on all levels. """
+    return tuple([hsh >> shift & BMAP for shift in SHIFTS])
+
+
+def hashorder(root, start=None, stop=None):
+    """ Yield (position, node) for the AssocNodes in the tree root whose
+    position lies after start and before stop, in the order of their
+    positions. The position of a node is the hashpath of its hash followed
+    by its index in the HashCollisionNode, or 0, so this is the order in
+    which the tree is laid out. start and stop may also be a prefix of a
+    position, which lies before all positions starting with it.
+    
+    Adding or removing keys of a HashCollisionNode, which may also reorder
+    a sorted one, shifts the indices of the others, so a position in it
+    only denotes the same entry in the version of the tree it came from.
+    
+    The stack is set up by descending along start, so resuming costs
+    O(depth) instead of the number of nodes skipped. """
+    stack = []
+    node = root
+    if start is not None:
+        for rlv in start[:DEPTH]:
+            if not isinstance(node, DispatchNode):
+                break
+            # The children after the one start leads to come next. They are
+            # pushed in reverse so the one with the lowest slot is popped
+            # first.
+            bitmap = node.bitmap & -(2 << rlv)
+            later = []
+            while bitmap:
+                bit = bitmap & -bitmap
+                bitmap ^= bit
+                later.append(node.child(bit.bit_length() - 1))
+            stack.extend(reversed(later))
+            if rlv >= BRANCH:
+                # start lies after all positions, as the ones shards
+                # returns for empty shards.
+                node = NULLNODE
+                break
+            node = node.child(rlv)
+    stack.append(node)
+    
+    while stack:
+        node = stack.pop()
+        if isinstance(node, DispatchNode):
+            stack.extend(reversed(list(node.iterchildren())))
+            continue
+        elif node is NULLNODE:
+            # start led to an empty slot.
+            continue
+        path = hashpath(node.hsh)
+        for idx, leaf in enumerate(node):
+            position = path + (idx, )
+            # Only the nodes start leads to can lie before it.
+            if start is not None and position <= start:
+                continue
+            if stop is not None and position >= stop:
+                return
+            yield position, leaf
+
+
+def findmany(root, keys):
+    """ Return a list of the leaves of the tree root with the given keys,
+    in the same order, with NULLNODE for keys that are not contained in it.
+    keys may be any iterable. Every key is looked up by a loop that neither
+    calls the nodes' get nor raises KeyError. """
+    found = []
+    append = found.append
+    for key in keys:
+        hsh = hash(key)
+        node = root
+        shift = 0
+        while isinstance(node, DispatchNode):
+            items = node.items
+            rlv = hsh >> shift & BMAP
+            if len(items) == BRANCH:
+                node = items[rlv]
+            else:
+                bitmap = node.bitmap
+                if not bitmap & BITS[rlv]:
+                    node = NULLNODE
+                    break
+                node = items[bit_count(bitmap & LOWER[rlv])]
+            shift += SHIFT
+        if node.__class__ in LEAVES:
+            if node.hsh == hsh and node.key == key:
+                append(node)
+            else:
+                append(NULLNODE)
+        else:
+            # A HashCollisionNode, whose find bisects sorted buckets, or
+            # NULLNODE, whose find returns itself.
+            append(node.find(hsh, shift, key))
+    return found
+
+
+def prefixes(root, depth):
+    """ Return a list of (prefix, size) pairs, ordered by prefix, for all
+    prefixes of length depth of the positions in the tree root, where size
+    is the number of AssocNodes whose positions start with it. """
+    result = []
+    stack = [((), root)]
+    while stack:
+        path, node = stack.pop()
+        if node is NULLNODE:
+            continue
+        elif len(path) == depth:
+            result.append((path, node.size))
+        elif isinstance(node, DispatchNode):
+            bitmap = node.bitmap
+            children = []
+            while bitmap:
+                bit = bitmap & -bitmap
+                bitmap ^= bit
+                rlv = bit.bit_length() - 1
+                children.append((path + (rlv, ), node.child(rlv)))
+            stack.extend(reversed(children))
+        else:
+            # A leaf or HashCollisionNode above depth, all of its nodes
+            # share the rest of the prefix.
+            result.append((hashpath(node.hsh)[:depth], node.size))
+    return result
+
+
+def mapnode(node, fn):
+    """ Return the node with fn applied to the values of all AssocNodes in
+    it. Subtrees for which fn returned the very same values are reused. """
+    if node.__class__ is AssocNode:
+        value = fn(node.value)
+        if value is node.value:
+            return node
+        return AssocNode(node.key, value)
+    elif isinstance(node, DispatchNode):
+        return node._replaced(
+            [mapnode(child, fn) for child in node.iterchildren()]
+        )
+    elif isinstance(node, HashCollisionNode):
+        children = [mapnode(child, fn) for child in node.children]
+        if all(a is b for a, b in zip(node.children, children)):
+            return node
+        return HashCollisionNode(children)
+    return node
+
+
+def filternode(node, pred):
+    """ Return the node containing only the AssocNodes for whose key and
+    value pred returned true. Subtrees for which it did so for all of them
+    are reused. """
+    if node.__class__ is AssocNode:
+        if pred(node.key, node.value):
+            return node
+        return NULLNODE
+    elif isinstance(node, DispatchNode):
+        return node._replaced(
+            [filternode(child, pred) for child in node.iterchildren()]
+        )
+    elif isinstance(node, HashCollisionNode):
+        return node._filtered(
+            [child for child in node.children if pred(child.key, child.value)]
+        )
+    return node
+
+
+def reducenode(node, fn, initial):
+    """ Return the result of calling fn(accumulator, key, value) for every
+    AssocNode in node, where accumulator is initial for the first one and
+    the previous result for all others. """
+    accumulator = initial
+    for leaf in node:
+        accumulator = fn(accumulator, leaf.key, leaf.value)
+    return accumulator
+
+
+def subtreejob(job):
+    """ Run the job (function, node, args) in a worker process by calling
+    function(node, *args). Return None if the result is node itself, so
+    the unchanged subtree does not have to be sent back. """
+    function, node, args = job
+    result = function(node, *args)
+    if result is node:
+        return None
+    return result
+
+
+def parallel(jobs, workers):
+    """ Return the results of subtreejob for all jobs, computed by a pool
+    of workers processes. The functions and arguments of the jobs need
+    to be picklable. """
+    if ProcessPoolExecutor is not None:
+        with ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(subtreejob, jobs))
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(subtreejob, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def treestats(root):
+    """ Return a dict describing the shape of the tree root. Its items are
+    
+    depths: the number of AssocNodes by the number of DispatchNodes above
+        them,
+    nodes: the number of nodes by the name of their class,
+    fanout: the average number of children of the DispatchNodes,
+    collisions: the number of HashCollisionNodes by their size,
+    bytes: the memory used by the nodes, not counting keys and values.
+    """
+    depths = Counter()
+    nodes = Counter()
+    collisions = Counter()
+    children = 0
+    dispatch = 0
+    nbytes = 0
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if node is NULLNODE:
+            continue
+        nodes[node.__class__.__name__] += 1
+        nbytes += sys.getsizeof(node)
+        if isinstance(node, DispatchNode):
+            dispatch += 1
+            nbytes += sys.getsizeof(node.items)
+            for child in node.iterchildren():
+                children += 1
+                stack.append((child, depth + 1))
+        elif isinstance(node, HashCollisionNode):
+            collisions[len(node.children)] += 1
+            nbytes += sys.getsizeof(node.children)
+            if node.keys is not None:
+                nbytes += sys.getsizeof(node.keys)
+            # The nodes in the bucket are at the same depth as the bucket.
+            stack.extend((child, depth) for child in node.children)
+        else:
+            depths[depth] += 1
+    return {
+        'depths': dict(depths),
+        'nodes': dict(nodes),
+        'fanout': float(children) / dispatch if dispatch else 0.0,
+        'collisions': dict(collisions),
+        'bytes': nbytes,
+    }
+
+
+def pathnodes(root, hsh):
+    """ Return the list of nodes the hash hsh leads to in the tree root,
+    starting at root and ending with the first node that is not a
+    DispatchNode. """
+    path = [root]
+    shift = 0
+    while isinstance(path[-1], DispatchNode):
+        path.append(path[-1].child(relevant(hsh, shift)))
+        shift += SHIFT
+    return path
+
+
+def entryhash(node):
+    """ Return the hash of the entry of the leaf node, or 0 for NULLNODE.
+    The hash of an AssocNode covers its value, so it raises TypeError if
+    the value is not hashable. """
+    if node is NULLNODE:
+        return 0
+    if node.__class__ is AssocNode:
+        return hash((node.key, node.value))
+    return node.hsh
+
+
+def nodeequal(shift, node, other):
+    """ Return whether the subtrees node and other at the given level
+    contain equal entries. Shared subtrees are equal without being looked
+    at, and DispatchNodes are only descended into if the same slots are
+    occupied in both, so comparing two versions of a tree costs time
+    proportional to the paths on which they differ. """
+    if node is other:
+        return True
+    if node.size != other.size:
+        return False
+    if isinstance(node, DispatchNode) and isinstance(other, DispatchNode):
+        # Every occupied slot holds at least one entry, so trees with the
+        # same entries occupy the same slots.
+        if node.bitmap != other.bitmap:
+            return False
+        shift += SHIFT
+        return all(
+            nodeequal(shift, child, ochild) for child, ochild in
+            zip(node.iterchildren(), other.iterchildren())
+        )
+    # The subtrees are shaped differently, or are leaves or buckets. As
+    # both contain the same number of entries, they are equal if all
+    # entries of node are in other.
+    for leaf in node:
+        found = other.find(leaf.hsh, shift, leaf.key)
+        if found is NULLNODE:
+            return False
+        if leaf.__class__ is AssocNode and not (
+            found.value is leaf.value or found.value == leaf.value):
+            return False
+    return True
+
+
+def leafcontent(node):
+    """ Return a hashable description of the entry of the leaf node. Leaves
+    are equal if their keys and their values are equal and of the same
+    type, or, for values that are not hashable, if their values are the
+    same object. """
+    value = getattr(node, 'value', SENTINEL)
+    try:
+        hash(value)
+    except TypeError:
+        # Unhashable values are only equal to themselves, id cannot be
+        # confused with the class of a value.
+        value, cls = id(value), id
+    else:
+        cls = value.__class__
+    return node.__class__, node.key.__class__, node.key, cls, value
+
+
+class InternedDispatchNode(DispatchNode):
+    """ DispatchNode created by a NodeTable, which only holds weak
+    references to it. No other node supports them, so that trees that are
+    never interned do not pay for it. """
+    __slots__ = ['__weakref__']
+
+
+class InternedHashCollisionNode(HashCollisionNode):
+    """ HashCollisionNode created by a NodeTable, see
+    InternedDispatchNode. """
+    __slots__ = ['__weakref__']
+
+
+class NodeTable(object):
+    """ Table of nodes for hash-consing trees: interning a tree replaces
+    every subtree that is equal to one already interned by that one, so
+    trees that were built independently from overlapping data share their
+    common subtrees, and equal subtrees are the same object.
+    
+    Only DispatchNodes and HashCollisionNodes are kept in the table, as
+    copies that support weak references. They are equal if they have the
+    same leaves, see leafcontent, and the same other children, which are
+    the same objects once they have been interned. Leaves are shared along
+    with the nodes containing them.
+    
+    The table only holds weak references to its nodes, so they are
+    dropped from it once no tree uses them anymore. """
+    __slots__ = ['nodes', 'members']
+    def __init__(self):
+        # The interned nodes by their content.
+        self.nodes = weakref.WeakValueDictionary()
+        # The interned nodes by their id, so that subtrees that have
+        # already been interned are not descended into again.
+        self.members = weakref.WeakValueDictionary()
+    
+    def __len__(self):
+        return len(self.nodes)
+    
+    @staticmethod
+    def _content(children):
+        """ Return a hashable description of the interned children. """
+        return tuple(
+            leafcontent(child) if child.__class__ in LEAVES else id(child)
+            for child in children
+        )
+    
+    def intern(self, node):
+        """ Return the interned node equal to node, interning node and its
+        subtrees if there is none. Nodes are never modified, and leaves
+        are returned as they are. """
+        if (node is NULLNODE or node.__class__ in LEAVES or
+            self.members.get(id(node)) is node):
+            return node
+        if isinstance(node, DispatchNode):
+            children = [self.intern(child) for child in node.iterchildren()]
+            content = (node.bitmap, ) + self._content(children)
+            interned = self.nodes.get(content)
+            if interned is None:
+                interned = InternedDispatchNode(
+                    node.bitmap, DispatchNode.layout(node.bitmap, children),
+                    None, node.size
+                )
+        else:
+            children = [self.intern(child) for child in node.children]
+            content = (None, ) + self._content(children)
+            interned = self.nodes.get(content)
+            if interned is None:
+                keys = node.keys
+                interned = InternedHashCollisionNode(
+                    children, None, None if keys is None else keys[:]
+                )
+        interned = self.nodes.setdefault(content, interned)
+        self.members[id(interned)] = interned
+        return interned
+
+
+# Maps with fewer entries are processed in the calling process even if
+# workers are requested, as starting the pool and sending the subtrees to it
+# would cost more than it saves.
+MINPARALLEL = 10000
+
+
+def editing(volatile):
+    """ Return the edit token of volatile, or raise RuntimeError if it has
+    been made persistent. Methods that were bound before persistent() was
+    called must not modify it anymore, as it may be shared by then. """
+    if volatile.edit is None:
+        raise RuntimeError(
+            '%s used after persistent().' % volatile.__class__.__name__
+        )
+    return volatile.edit
+
+
+def release(*trees):
+    """ Give every volatile one of trees a new edit token, because its
+    nodes are about to be shared with a result that must not change. It
+    then copies the nodes it owns now before modifying them. Trees that
+    are persistent are left alone. """
+    for tree in trees:
+        if getattr(tree, 'edit', None) is not None:
+            tree.edit = object()
+
+
+class PersistentTreeMap(object):
+    __slots__ = ['root', 'hashed']
+    def __init__(self, root=NULLNODE, hashed=None):
+        self.root = root
+        # The sum of the entryhash of all entries, or None until it is
+        # needed by __hash__. New versions created by assoc and without
+        # derive it from the one of their predecessor. Volatile maps can
+        # only be hashed once they cannot be modified anymore, so it never
+        # becomes stale.
+        self.hashed = hashed
+    
+    def __getitem__(self, key):
+        return self.root.get(hash(key), 0, key).value
+    
+    def __len__(self):
+        return self.root.size
+    
+    def __contains__(self, key):
+        return self.root.find(hash(key), 0, key) is not NULLNODE
+    
+    def get(self, key, default=None):
+        """ Return the value of key, or default if self does not contain
+        it. """
+        node = self.root.find(hash(key), 0, key)
+        if node is NULLNODE:
+            return default
+        return node.value
+    
+    def get_hashed(self, key, hsh, default=None):
+        """ Like get, but use hsh instead of hashing key. hsh must be
+        hash(key), so hashes of expensive keys can be computed once and
+        reused for any number of operations. """
+        node = self.root.find(hsh, 0, key)
+        if node is NULLNODE:
+            return default
+        return node.value
+    
+    def __reduce__(self):
+        # VolatileTreeMaps are pickled as persistent ones.
+        return PersistentTreeMap, (self.root,)
+    
+    def __eq__(self, other):
+        """ Return whether self and other contain equal entries. Subtrees
+        shared by both are not compared, see nodeequal. """
+        if not isinstance(other, PersistentTreeMap):
+            return NotImplemented
+        if (self.hashed is not None and other.hashed is not None and
+            self.hashed != other.hashed):
+            return False
+        return nodeequal(0, self.root, other.root)
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+    
+    def __hash__(self):
+        """ Return hash of self. It is computed from all entries the first
+        time, after which it is cached, and maintained by assoc and
+        without. Raise TypeError if any value is not hashable. """
+        hashed = self.hashed
+        if hashed is None:
+            hashed = self.hashed = sum(imap(entryhash, self.root))
+        return hash(hashed)
+    
+    def _rehashed(self, hsh, key, node):
+        """ Return the hashed value for the copy of self whose entry for key
+        is replaced by the leaf node, or removed if it is NULLNODE. Return
+        None if that of self has not been computed yet. """
+        hashed = self.hashed
+        if hashed is None:
+            return None
+        try:
+            return (
+                hashed - entryhash(self.root.find(hsh, 0, key)) +
+                entryhash(node)
+            )
+        except TypeError:
+            # Maps with unhashable values cannot be hashed anyway.
+            return None
+    
+    def __and__(self, other):
+        """ Return the entries of self whose keys are also in other. """
+        release(self, other)
+        return PersistentTreeMap(self.root.intersection(0, other.root))
+    
+    def __sub__(self, other):
+        """ Return the entries of self whose keys are not in other. """
+        release(self, other)
+        return PersistentTreeMap(self.root.difference(0, other.root))
     
     def __xor__(self, other):
-        new = self.root
-        for node in other.root:
-            new = new.xor(node.hsh, 0, node)
-        return PersistentTreeMap(new)
+        """ Return the entries of self and other whose keys are only in
+        one of them. """
+        release(self, other)
+        return PersistentTreeMap(
+            self.root.symmetric_difference(0, other.root)
+        )
     
     def __or__(self, other):
-        new = self.root
-        for node in other.root:
-            new = new.replace(node.hsh, 0, node)
-        return PersistentTreeMap(new)
+        """ Return the union of self and other. If both contain a key,
+        the value in other wins. """
+        release(self, other)
+        return PersistentTreeMap(self.root.union(0, other.root))
     
     def assoc(self, key, value):
         """ Return copy of self with an association between key and value.
         May override an existing association. """
+        hsh = hash(key)
+        node = AssocNode(key, value, hsh)
         return PersistentTreeMap(
-            self.root.assoc(hash(key), 0, AssocNode(key, value))
+            self.root.assoc(hsh, 0, node), self._rehashed(hsh, key, node)
         )
     
     def without(self, key):
         """ Return copy of self with key removed. """
+        hsh = hash(key)
+        return PersistentTreeMap(
+            self.root.without(hsh, 0, key), self._rehashed(hsh, key, NULLNODE)
+        )
+    
+    def assoc_hashed(self, key, hsh, value):
+        """ Like assoc, but use hsh, which must be hash(key), instead of
+        hashing key. """
+        node = AssocNode(key, value, hsh)
+        return PersistentTreeMap(
+            self.root.assoc(hsh, 0, node), self._rehashed(hsh, key, node)
+        )
+    
+    def without_hashed(self, key, hsh):
+        """ Like without, but use hsh, which must be hash(key), instead of
+        hashing key. """
         return PersistentTreeMap(
-            self.root.without(hash(key), 0, key)
+            self.root.without(hsh, 0, key), self._rehashed(hsh, key, NULLNODE)
+        )
+    
+    def update(self, items):
+        """ Return copy of self with associations between the keys and
+        values of the (key, value) pairs in items, overriding existing
+        ones. Unlike calling assoc for every pair, this copies every node
+        on the changed paths only once, by modifying the copies in place
+        while the batch is applied. """
+        return PersistentTreeMap(VolatileTreeMap(self.root).update(items).root)
+    
+    def without_many(self, keys):
+        """ Return copy of self with all of keys removed, copying every node
+        only once like update. Keys that are not contained in self are
+        ignored. """
+        return PersistentTreeMap(
+            VolatileTreeMap(self.root).without_many(keys).root
         )
     
     def __iter__(self):
-        for node in self.root:
-            yield node.key
+        return imap(attrgetter('key'), self.root)
     
     iterkeys = __iter__
     
+    def cursor(self, start=None, stop=None):
+        """ Yield (position, key, value) for the entries of self in the
+        order of their hashes. The positions are opaque, but they are
+        tuples of small integers, so they can be stored and sent anywhere.
+        If start is given, iteration resumes after the entry at start, and
+        it ends before stop. Resuming is O(depth), the entries before start
+        are not visited.
+        
+        start may also have been obtained from another version of the map,
+        even one without the entry at start, unless that entry is one of
+        several keys with the same hash whose bucket was changed between
+        the versions. Entries of that bucket may then be skipped or
+        repeated, see hashorder. """
+        for position, node in hashorder(self.root, start, stop):
+            yield position, node.key, node.value
+    
+    def page(self, count, start=None):
+        """ Return a list of the next count (key, value) pairs after start
+        in the order of cursor, and the position to pass as start to get
+        the page after it, or None if there are no more entries. Raise
+        ValueError if count is smaller than 1. """
+        if count < 1:
+            raise ValueError('count must be at least 1, not %r.' % count)
+        items = []
+        position = start
+        for position, key, value in self.cursor(start):
+            items.append((key, value))
+            if len(items) == count:
+                return items, position
+        return items, None
+    
+    def shards(self, n):
+        """ Split self by the prefixes of the positions into n disjoint
+        ranges of roughly equal numbers of entries. Return a list of n
+        (start, stop) pairs to pass to cursor, which together cover all of
+        the map. Some of them may be empty if self has few entries. Raise
+        ValueError if n is smaller than 1. """
+        if n < 1:
+            raise ValueError('n must be at least 1, not %r.' % n)
+        depth = 1
+        while BRANCH ** depth < n and depth < DEPTH:
+            depth += 1
+        groups = prefixes(self.root, depth)
+        
+        # The first prefix of every shard but the first is the boundary to
+        # the one before it.
+        bounds = [None]
+        total = float(self.root.size)
+        seen = 0
+        for prefix, size in groups:
+            while len(bounds) < n and seen >= total * len(bounds) / n:
+                bounds.append(prefix)
+            seen += size
+        # The shards that did not get a prefix start after all positions,
+        # which makes them empty.
+        bounds.extend([(BRANCH, )] * (n - len(bounds)))
+        bounds.append(None)
+        return zip(bounds, bounds[1:])
+    
+    def get_many(self, keys, default=None):
+        """ Return a list of the values of keys, in the same order, with
+        default for keys that are not contained in self. This is a lot
+        cheaper than looking up every key with __getitem__, especially if
+        many of them are missing. """
+        return [
+            default if leaf is NULLNODE else leaf.value
+            for leaf in findmany(self.root, keys)
+        ]
+    
+    def contains_many(self, keys):
+        """ Return a list of whether each of keys is contained in self. """
+        return [leaf is not NULLNODE for leaf in findmany(self.root, keys)]
+    
+    def _split(self, function, args, workers):
+        """ Return the children of the root node and the results of
+        subtreejob for function and args on each of them, or None if the
+        map should not be processed in parallel. """
+        root = self.root
+        if (workers <= 1 or root.size < MINPARALLEL or
+            not isinstance(root, DispatchNode)):
+            return None
+        children = list(root.iterchildren())
+        return children, parallel(
+            [(function, child, args) for child in children], workers
+        )
+    
+    def map_values(self, fn, workers=1):
+        """ Return a map with the same keys as self whose values are the
+        results of fn for the values of self. Subtrees in which fn returned
+        the very same values are shared with self. If workers is more than
+        1, the subtrees below the root are processed by that many processes,
+        so fn must be picklable, e.g. a module level function. """
+        release(self)
+        split = self._split(mapnode, (fn, ), workers)
+        if split is None:
+            return PersistentTreeMap(mapnode(self.root, fn))
+        children, results = split
+        return PersistentTreeMap(self.root._replaced([
+            child if result is None else result
+            for child, result in zip(children, results)
+        ]))
+    
+    def filter(self, pred, workers=1):
+        """ Return a map with the entries of self for whose key and value
+        pred returns true. Subtrees that are kept completely are shared
+        with self. workers is the same as for map_values. """
+        release(self)
+        split = self._split(filternode, (pred, ), workers)
+        if split is None:
+            return PersistentTreeMap(filternode(self.root, pred))
+        children, results = split
+        return PersistentTreeMap(self.root._replaced([
+            child if result is None else result
+            for child, result in zip(children, results)
+        ]))
+    
+    def reduce(self, fn, initial, combine=None, workers=1):
+        """ Return the result of calling fn(accumulator, key, value) for
+        every entry of self, where accumulator is initial for the first
+        entry and the previous result for all others. If combine is given
+        and workers is more than 1, the subtrees below the root are reduced
+        by that many processes, each starting with initial, and the partial
+        results are merged with combine(accumulator, partial). This is only
+        correct if initial is neutral to combine and the order of the
+        entries does not matter. """
+        if combine is None:
+            return reducenode(self.root, fn, initial)
+        split = self._split(reducenode, (fn, initial), workers)
+        if split is None:
+            return reducenode(self.root, fn, initial)
+        children, results = split
+        return reduce(combine, results)
+    
+    def stats(self):
+        """ Return a dict describing the shape of the trie. See treestats
+        for its contents. """
+        return treestats(self.root)
+    
+    def profiled(self, counters=None):
+        """ Return a ProfiledTreeMap with the contents of self that records
+        the work done by its operations in counters. """
+        release(self)
+        return ProfiledTreeMap(self.root, counters, self.hashed)
+    
+    def interned(self, table):
+        """ Return copy of self whose nodes are interned in the NodeTable
+        table, so that it shares all subtrees that are equal to ones of
+        other maps interned in table. Subtrees that are already interned
+        are not visited again, so interning a new version of an interned
+        map only costs time proportional to the changes. """
+        return PersistentTreeMap(table.intern(self.root))
+    
+    def diff(self, other):
+        """ Yield (key, old, new) for every key whose value differs between
+        other, an older version of this map, and self. For keys that were
+        added old is SENTINEL, for keys that were removed new is SENTINEL.
+        Subtrees that both versions share are skipped, so this costs time
+        proportional to the changes, not to the size of the maps. """
+        for onode, node in self.root.diff(0, other.root):
+            if onode is NULLNODE:
+                yield node.key, SENTINEL, node.value
+            elif node is NULLNODE:
+                yield onode.key, onode.value, SENTINEL
+            elif (onode.value is not node.value and
+                  onode.value != node.value):
+                yield node.key, onode.value, node.value
+    
     def iteritems(self):
-        for node in self.root:
-            yield node.key, node.value
+        return imap(attrgetter('key', 'value'), self.root)
     
     def itervalues(self):
-        for node in self.root:
-            yield node.value
+        return imap(attrgetter('value'), self.root)
+    
+    @staticmethod
+    def from_items(items):
+        """ Create PersistentTreeMap from an iterable of (key, value) pairs.
+        If a key occurs more than once, the last value wins. The order of
+        the pairs does not matter. """
+        nodes = [AssocNode(key, value) for key, value in items]
+        if not nodes:
+            return PersistentTreeMap()
+        return PersistentTreeMap(DispatchNode.build(0, nodes))
     
     @staticmethod
     def from_dict(dct):
         """ Create PersistentTreeMap from existing dictionary. """
-        mp = VolatileTreeMap()
-        for key, value in dct.iteritems():
-            mp = mp.assoc(key, value)
-        return mp.persistent()
+        return PersistentTreeMap.from_items(dct.iteritems())
+    
+    def dump(self, fileobj):
+        """ Write to fileobj in the binary format read by load. """
+        NodeWriter(fileobj).dump(self.root)
+    
+    @staticmethod
+    def load(path):
+        """ Return PersistentTreeMap stored at path by dump. The file is
+        memory mapped and nodes are only read when they are first reached
+        by a lookup, an iteration or a modification. """
+        return PersistentTreeMap(NodeReader.open(path).root())
     
     def volatile(self):
-        return VolatileTreeMap(deepcopy(self.root))
+        """ Return VolatileTreeMap with the contents of self. This is O(1),
+        nodes are only copied once they are first modified through it. """
+        release(self)
+        return VolatileTreeMap(self.root)
 
 
 class VolatileTreeMap(PersistentTreeMap):
+    """ Map that is modified in place. Every VolatileTreeMap has an edit
+    token, and nodes carrying that token have been created by it and are not
+    visible to anything else, so they may be modified in place. All other
+    nodes are copied on their first modification. """
     _assoc = PersistentTreeMap.assoc
     _without = PersistentTreeMap.without
+    _update = PersistentTreeMap.update
+    _without_many = PersistentTreeMap.without_many
+    _assoc_hashed = PersistentTreeMap.assoc_hashed
+    _without_hashed = PersistentTreeMap.without_hashed
+    
+    def __init__(self, root=NULLNODE):
+        PersistentTreeMap.__init__(self, root)
+        self.edit = object()
+    
+    def __hash__(self):
+        # The contents of the map may still change.
+        if self.edit is not None:
+            raise TypeError('unhashable type: VolatileTreeMap')
+        return PersistentTreeMap.__hash__(self)
     
     def assoc(self, key, value):
         """ Update this VolatileTreeMap to contain an association between
         key and value.
         
         USE WITH CAUTION: This should only be used if no other reference
-        to the PersistentTreeMap may exist. """
-        self.root = self.root._iassoc(hash(key), 0, AssocNode(key, value))
+        to this VolatileTreeMap may exist. """
+        self.root = self.root._iassoc(
+            hash(key), 0, AssocNode(key, value), editing(self)
+        )
         return self
     
     def without(self, key):
         """ Remove key.
         
         USE WITH CAUTION: This should only be used if no other reference
-        to the PersistentTreeMap may exist. """
-        self.root = self.root._iwithout(hash(key), 0, key)
+        to this VolatileTreeMap may exist. """
+        self.root = self.root._iwithout(hash(key), 0, key, editing(self))
+        return self
+    
+    def assoc_hashed(self, key, hsh, value):
+        """ Like assoc, but use hsh, which must be hash(key), instead of
+        hashing key.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeMap may exist. """
+        self.root = self.root._iassoc(
+            hsh, 0, AssocNode(key, value, hsh), editing(self)
+        )
+        return self
+    
+    def without_hashed(self, key, hsh):
+        """ Like without, but use hsh, which must be hash(key), instead of
+        hashing key.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeMap may exist. """
+        self.root = self.root._iwithout(hsh, 0, key, editing(self))
+        return self
+    
+    def update(self, items):
+        """ Update this VolatileTreeMap to contain associations between the
+        keys and values of the (key, value) pairs in items.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeMap may exist. """
+        root = self.root
+        edit = editing(self)
+        for key, value in items:
+            root = root._iassoc(hash(key), 0, AssocNode(key, value), edit)
+        self.root = root
+        return self
+    
+    def without_many(self, keys):
+        """ Remove all of keys, ignoring the ones not contained in this
+        VolatileTreeMap.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeMap may exist. """
+        root = self.root
+        edit = editing(self)
+        for key in keys:
+            try:
+                root = root._iwithout(hash(key), 0, key, edit)
+            except KeyError:
+                pass
+        self.root = root
         return self
     
     def persistent(self):
+        """ Make this map persistent. Its nodes will not be modified in
+        place anymore, because the edit token they carry is dropped. """
         self.without = self._without
         self.assoc = self._assoc
+        self.update = self._update
+        self.without_many = self._without_many
+        self.assoc_hashed = self._assoc_hashed
+        self.without_hashed = self._without_hashed
+        self.edit = None
         
         return self
 
 
+class ProfiledTreeMap(PersistentTreeMap):
+    """ PersistentTreeMap that counts the nodes allocated by every assoc
+    and without and the nodes visited by every lookup. counters maps each
+    of 'assoc', 'without' and 'get' to a Counter of how often each number
+    was recorded, and 'update' and 'without_many' to one of the numbers of
+    nodes allocated by a whole batch. It is shared by all maps derived
+    from this one, which are ProfiledTreeMaps as well.
+    
+    The counting is done by walking the paths of the keys again after the
+    operations, so plain PersistentTreeMaps pay nothing for it. """
+    __slots__ = ['counters']
+    def __init__(self, root=NULLNODE, counters=None, hashed=None):
+        PersistentTreeMap.__init__(self, root, hashed)
+        if counters is None:
+            counters = {
+                'assoc': Counter(), 'without': Counter(), 'get': Counter(),
+                'update': Counter(), 'without_many': Counter(),
+            }
+        self.counters = counters
+    
+    def _derived(self, new):
+        """ Return new, a PersistentTreeMap derived from self, as a
+        ProfiledTreeMap sharing the counters of self. """
+        return ProfiledTreeMap(new.root, self.counters, new.hashed)
+    
+    def _allocated(self, new, hashes):
+        """ Return the set of the ids of the nodes on the paths of hashes in
+        new, a PersistentTreeMap derived from self, that are not in self
+        at the same place. """
+        allocated = set()
+        for hsh in hashes:
+            old = pathnodes(self.root, hsh)
+            for idx, node in enumerate(pathnodes(new.root, hsh)):
+                if node is not NULLNODE and (
+                    idx >= len(old) or node is not old[idx]):
+                    allocated.add(id(node))
+        return allocated
+    
+    def _changed(self, operation, new, hshs):
+        """ Record the number of nodes allocated on the paths of the hashes
+        hshs by operation, which resulted in new. Return new as a
+        ProfiledTreeMap. """
+        self.counters[operation][len(self._allocated(new, hshs))] += 1
+        return self._derived(new)
+    
+    def _looked_up(self, hsh):
+        """ Record a lookup of hsh. """
+        self.counters['get'][len(pathnodes(self.root, hsh))] += 1
+    
+    def assoc(self, key, value):
+        return self._changed(
+            'assoc', PersistentTreeMap.assoc(self, key, value), [hash(key)]
+        )
+    
+    def without(self, key):
+        return self._changed(
+            'without', PersistentTreeMap.without(self, key), [hash(key)]
+        )
+    
+    def assoc_hashed(self, key, hsh, value):
+        return self._changed(
+            'assoc', PersistentTreeMap.assoc_hashed(self, key, hsh, value),
+            [hsh]
+        )
+    
+    def without_hashed(self, key, hsh):
+        return self._changed(
+            'without', PersistentTreeMap.without_hashed(self, key, hsh), [hsh]
+        )
+    
+    def update(self, items):
+        items = list(items)
+        return self._changed(
+            'update', PersistentTreeMap.update(self, items),
+            [hash(key) for key, _ in items]
+        )
+    
+    def without_many(self, keys):
+        keys = list(keys)
+        return self._changed(
+            'without_many', PersistentTreeMap.without_many(self, keys),
+            map(hash, keys)
+        )
+    
+    def __getitem__(self, key):
+        self._looked_up(hash(key))
+        return PersistentTreeMap.__getitem__(self, key)
+    
+    def __contains__(self, key):
+        self._looked_up(hash(key))
+        return PersistentTreeMap.__contains__(self, key)
+    
+    def get(self, key, default=None):
+        self._looked_up(hash(key))
+        return PersistentTreeMap.get(self, key, default)
+    
+    def get_hashed(self, key, hsh, default=None):
+        self._looked_up(hsh)
+        return PersistentTreeMap.get_hashed(self, key, hsh, default)
+    
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        for key in keys:
+            self._looked_up(hash(key))
+        return PersistentTreeMap.get_many(self, keys, default)
+    
+    def contains_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self._looked_up(hash(key))
+        return PersistentTreeMap.contains_many(self, keys)
+    
+    def __and__(self, other):
+        return self._derived(PersistentTreeMap.__and__(self, other))
+    
+    def __sub__(self, other):
+        return self._derived(PersistentTreeMap.__sub__(self, other))
+    
+    def __xor__(self, other):
+        return self._derived(PersistentTreeMap.__xor__(self, other))
+    
+    def __or__(self, other):
+        return self._derived(PersistentTreeMap.__or__(self, other))
+    
+    def map_values(self, fn, workers=1):
+        return self._derived(PersistentTreeMap.map_values(self, fn, workers))
+    
+    def filter(self, pred, workers=1):
+        return self._derived(PersistentTreeMap.filter(self, pred, workers))
+    
+    def interned(self, table):
+        return self._derived(PersistentTreeMap.interned(self, table))
+
+
 class PersistentTreeSet(object):
-    __slots__ = ['root']
-    def __init__(self, root=NULLNODE):
+    __slots__ = ['root', 'hashed']
+    def __init__(self, root=NULLNODE, hashed=None):
         self.root = root
+        # The sum of the hashes of the keys, see PersistentTreeMap.
+        self.hashed = hashed
     
     def __contains__(self, key):
-        try:
-            self.root.get(hash(key), 0, key)
-            return  True
-        except KeyError:
+        return self.root.find(hash(key), 0, key) is not NULLNODE
+    
+    def __len__(self):
+        return self.root.size
+    
+    def __reduce__(self):
+        return PersistentTreeSet, (self.root,)
+    
+    def __eq__(self, other):
+        """ Return whether self and other contain equal keys, see
+        PersistentTreeMap.__eq__. """
+        if not isinstance(other, PersistentTreeSet):
+            return NotImplemented
+        if (self.hashed is not None and other.hashed is not None and
+            self.hashed != other.hashed):
             return False
+        return nodeequal(0, self.root, other.root)
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+    
+    def __hash__(self):
+        """ Return hash of self, see PersistentTreeMap.__hash__. """
+        hashed = self.hashed
+        if hashed is None:
+            hashed = self.hashed = sum(imap(entryhash, self.root))
+        return hash(hashed)
+    
+    def _rehashed(self, hsh, key, node):
+        """ Return the hashed value for the copy of self whose entry for key
+        is replaced by the leaf node, see PersistentTreeMap._rehashed. """
+        hashed = self.hashed
+        if hashed is None:
+            return None
+        return (
+            hashed - entryhash(self.root.find(hsh, 0, key)) + entryhash(node)
+        )
     
     def add(self, key):
-        """ Return copy of self with an association between key and value.
-        May override an existing association. """
-        return PersistentTreeMap(
-            self.root.assoc(hash(key), 0, SetNode(key))
+        """ Return copy of self with key added. """
+        hsh = hash(key)
+        node = SetNode(key, hsh)
+        return PersistentTreeSet(
+            self.root.assoc(hsh, 0, node), self._rehashed(hsh, key, node)
         )
     
     def without(self, key):
         """ Return copy of self with key removed. """
-        return PersistentTreeMap(
-            self.root.without(hash(key), 0, key)
+        hsh = hash(key)
+        return PersistentTreeSet(
+            self.root.without(hsh, 0, key), self._rehashed(hsh, key, NULLNODE)
+        )
+    
+    def update(self, keys):
+        """ Return copy of self with all of keys added, copying every node
+        only once like PersistentTreeMap.update. """
+        return PersistentTreeSet(VolatileTreeSet(self.root).update(keys).root)
+    
+    def without_many(self, keys):
+        """ Return copy of self with all of keys removed, copying every node
+        only once. Keys that are not contained in self are ignored. """
+        return PersistentTreeSet(
+            VolatileTreeSet(self.root).without_many(keys).root
+        )
+    
+    def issubset(self, other):
+        """ Return whether all keys of self are contained in other. """
+        return len(self) <= len(other) and (
+            self.root.difference(0, other.root) is NULLNODE
+        )
+    
+    def isdisjoint(self, other):
+        """ Return whether self and other have no keys in common. """
+        return self.root.intersection(0, other.root) is NULLNODE
+    
+    def __or__(self, other):
+        """ Return the union of self and other. """
+        release(self, other)
+        return PersistentTreeSet(self.root.union(0, other.root))
+    
+    def __and__(self, other):
+        """ Return the intersection of self and other. """
+        release(self, other)
+        return PersistentTreeSet(self.root.intersection(0, other.root))
+    
+    def __sub__(self, other):
+        """ Return the difference of self and other. """
+        release(self, other)
+        return PersistentTreeSet(self.root.difference(0, other.root))
+    
+    def __xor__(self, other):
+        """ Return the symmetric difference of self and other. """
+        release(self, other)
+        return PersistentTreeSet(
+            self.root.symmetric_difference(0, other.root)
         )
     
     def __iter__(self):
-        for node in self.root:
-            yield node.key
+        return imap(attrgetter('key'), self.root)
     
     @staticmethod
     def from_set(set_):
-        """ Create PersistentTreeSet from existing set. """
-        mp = VolatileTreeSet()
-        for key in set_:
-            mp = mp.add(key)
-        return mp.persistent()
+        """ Create PersistentTreeSet from existing set, or any iterable of
+        keys, which may contain duplicates. Like
+        PersistentTreeMap.from_items, the trie is built bottom-up. """
+        nodes = [SetNode(key) for key in set_]
+        if not nodes:
+            return PersistentTreeSet()
+        return PersistentTreeSet(DispatchNode.build(0, nodes))
     
-    def volatile(self):
-        return VolatileTreeSet(deepcopy(self.root))
-
-
+    def dump(self, fileobj):
+        """ Write to fileobj in the binary format read by load. """
+        NodeWriter(fileobj).dump(self.root)
+    
+    @staticmethod
+    def load(path):
+        """ Return PersistentTreeSet stored at path by dump. The file is
+        memory mapped and nodes are only read when they are first
+        reached. """
+        return PersistentTreeSet(NodeReader.open(path).root())
+    
+    def interned(self, table):
+        """ Return copy of self whose nodes are interned in the NodeTable
+        table, see PersistentTreeMap.interned. """
+        return PersistentTreeSet(table.intern(self.root))
+    
+    def volatile(self):
+        """ Return VolatileTreeSet with the contents of self. This is O(1),
+        nodes are only copied once they are first modified through it. """
+        release(self)
+        return VolatileTreeSet(self.root)
+
+
 class VolatileTreeSet(PersistentTreeSet):
+    """ Set that is modified in place, see VolatileTreeMap. """
     _add = PersistentTreeSet.add
     _without = PersistentTreeSet.without
+    _update = PersistentTreeSet.update
+    _without_many = PersistentTreeSet.without_many
+    
+    def __init__(self, root=NULLNODE):
+        PersistentTreeSet.__init__(self, root)
+        self.edit = object()
+    
+    def __hash__(self):
+        # The contents of the set may still change.
+        if self.edit is not None:
+            raise TypeError('unhashable type: VolatileTreeSet')
+        return PersistentTreeSet.__hash__(self)
     
     def add(self, key):
-        """ Update this VolatileTreeMap to contain an association between
+        """ Add key to this VolatileTreeSet.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeSet may exist. """
+        self.root = self.root._iassoc(
+            hash(key), 0, SetNode(key), editing(self)
+        )
+        return self
+    
+    def without(self, key):
+        """ Remove key.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeSet may exist. """
+        self.root = self.root._iwithout(hash(key), 0, key, editing(self))
+        return self
+    
+    def update(self, keys):
+        """ Add all of keys to this VolatileTreeSet.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeSet may exist. """
+        root = self.root
+        edit = editing(self)
+        for key in keys:
+            root = root._iassoc(hash(key), 0, SetNode(key), edit)
+        self.root = root
+        return self
+    
+    def without_many(self, keys):
+        """ Remove all of keys, ignoring the ones not contained in this
+        VolatileTreeSet.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileTreeSet may exist. """
+        root = self.root
+        edit = editing(self)
+        for key in keys:
+            try:
+                root = root._iwithout(hash(key), 0, key, edit)
+            except KeyError:
+                pass
+        self.root = root
+        return self
+    
+    def persistent(self):
+        """ Make this set persistent. Its nodes will not be modified in
+        place anymore, because the edit token they carry is dropped. """
+        self.without = self._without
+        self.add = self._add
+        self.update = self._update
+        self.without_many = self._without_many
+        self.edit = None
+        
+        return self
+
+
+def newpath(level, node, edit=None):
+    """ Return node wrapped in VectorNodes up to level. """
+    while level:
+        node = VectorNode([node], edit)
+        level -= SHIFT
+    return node
+
+
+class VectorNode(object):
+    """ Node of the trie of a PersistentVector. On the lowest level,
+    children are the values, on all others they are VectorNodes. Like the
+    nodes of the maps, a node may only be modified in place by the
+    VolatileVector whose edit token it carries. """
+    __slots__ = ['children', 'edit']
+    def __init__(self, children, edit=None):
+        self.children = children
+        self.edit = edit
+    
+    def __reduce__(self):
+        return VectorNode, (self.children, )
+    
+    def _editable(self, edit):
+        """ Return self if it is owned by edit, otherwise a copy of self
+        that is. Persistent operations pass None and always get a copy. """
+        if edit is not None and self.edit is edit:
+            return self
+        return VectorNode(self.children[:], edit)
+    
+    def pushtail(self, level, idx, tailnode, edit):
+        """ Return the node with tailnode, the leaf containing the values
+        from index idx on, added after the last leaf. level is the shift of
+        this node. """
+        new = self._editable(edit)
+        children = new.children
+        rlv = relevant(idx, level)
+        if level == SHIFT:
+            child = tailnode
+        elif rlv < len(children):
+            child = children[rlv].pushtail(level - SHIFT, idx, tailnode, edit)
+        else:
+            child = newpath(level - SHIFT, tailnode, edit)
+        
+        if rlv < len(children):
+            children[rlv] = child
+        else:
+            children.append(child)
+        return new
+    
+    def poptail(self, level, idx, edit):
+        """ Return the node without its last leaf, which contains index idx,
+        or None if the node becomes empty. level is the shift of this
+        node. """
+        rlv = relevant(idx, level)
+        if level > SHIFT:
+            child = self.children[rlv].poptail(level - SHIFT, idx, edit)
+            if child is None and rlv == 0:
+                return None
+            new = self._editable(edit)
+            if child is None:
+                del new.children[rlv]
+            else:
+                new.children[rlv] = child
+            return new
+        if rlv == 0:
+            return None
+        new = self._editable(edit)
+        del new.children[rlv]
+        return new
+    
+    def assoc(self, level, idx, value, edit):
+        """ Return the node with the value at index idx replaced by value.
+        level is the shift of this node. """
+        new = self._editable(edit)
+        rlv = relevant(idx, level)
+        if level:
+            new.children[rlv] = new.children[rlv].assoc(
+                level - SHIFT, idx, value, edit
+            )
+        else:
+            new.children[rlv] = value
+        return new
+
+
+class PersistentVector(object):
+    """ Immutable sequence stored in a trie whose levels dispatch on the
+    bits of the index, BRANCH values per leaf, in the same way the maps
+    dispatch on the bits of the hash. The last up to BRANCH values are kept
+    in tail outside of the trie, so appending only has to touch the trie
+    once every BRANCH values. """
+    __slots__ = ['count', 'shift', 'root', 'tail']
+    def __init__(self, count=0, shift=SHIFT, root=None, tail=None):
+        if root is None:
+            root = VectorNode([])
+        if tail is None:
+            tail = []
+        
+        self.count = count
+        # The shift of the root, the lowest level has shift 0.
+        self.shift = shift
+        self.root = root
+        self.tail = tail
+    
+    def __len__(self):
+        return self.count
+    
+    def __reduce__(self):
+        # VolatileVectors are pickled as persistent ones.
+        return PersistentVector, (self.count, self.shift, self.root, self.tail)
+    
+    def _index(self, idx):
+        """ Return idx, with negative indices counted from the end, or
+        raise IndexError if it is out of range. """
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('vector index out of range')
+        return idx
+    
+    def _leaf(self, idx):
+        """ Return the list containing the value at index idx. """
+        if idx >= self.count - len(self.tail):
+            return self.tail
+        node = self.root
+        level = self.shift
+        while level:
+            node = node.children[idx >> level & BMAP]
+            level -= SHIFT
+        return node.children
+    
+    def __getitem__(self, idx):
+        idx = self._index(idx)
+        return self._leaf(idx)[idx & BMAP]
+    
+    def __iter__(self):
+        return chain.from_iterable(self.chunks())
+    
+    def chunks(self):
+        """ Yield the lists of values of the leaves in order, the tail last.
+        """
+        stack = [(self.root, self.shift)]
+        while stack:
+            node, level = stack.pop()
+            if level:
+                stack.extend(
+                    (child, level - SHIFT) for child in reversed(node.children)
+                )
+            else:
+                yield node.children
+        yield self.tail
+    
+    def _pushtail(self, edit):
+        """ Return the shift and root of the trie with the full tail added
+        to it. """
+        tailnode = VectorNode(self.tail, edit)
+        if self.count >> SHIFT > 1 << self.shift:
+            # The trie is full, so it gets another level.
+            return self.shift + SHIFT, VectorNode(
+                [self.root, newpath(self.shift, tailnode, edit)], edit
+            )
+        return self.shift, self.root.pushtail(
+            self.shift, self.count - BRANCH, tailnode, edit
+        )
+    
+    def _poptail(self, edit):
+        """ Return the shift, root and tail of the vector whose tail is the
+        last leaf of the trie, which is removed from it. """
+        idx = self.count - 2
+        tail = self._leaf(idx)[:]
+        root = self.root.poptail(self.shift, idx, edit)
+        shift = self.shift
+        if root is None:
+            root = VectorNode([], edit)
+        elif shift > SHIFT and len(root.children) == 1:
+            root = root.children[0]
+            shift -= SHIFT
+        return shift, root, tail
+    
+    def append(self, value):
+        """ Return copy of self with value appended. """
+        if len(self.tail) < BRANCH:
+            return PersistentVector(
+                self.count + 1, self.shift, self.root, self.tail + [value]
+            )
+        shift, root = self._pushtail(None)
+        return PersistentVector(self.count + 1, shift, root, [value])
+    
+    def assoc(self, idx, value):
+        """ Return copy of self with the value at index idx replaced by
+        value. If idx is the length of self, value is appended. """
+        if idx == self.count:
+            return self.append(value)
+        idx = self._index(idx)
+        if idx >= self.count - len(self.tail):
+            tail = self.tail[:]
+            tail[idx & BMAP] = value
+            return PersistentVector(self.count, self.shift, self.root, tail)
+        return PersistentVector(
+            self.count, self.shift,
+            self.root.assoc(self.shift, idx, value, None), self.tail
+        )
+    
+    def pop(self):
+        """ Return copy of self without its last value. """
+        if not self.count:
+            raise IndexError('pop from empty vector')
+        if len(self.tail) > 1 or self.count == 1:
+            return PersistentVector(
+                self.count - 1, self.shift, self.root, self.tail[:-1]
+            )
+        shift, root, tail = self._poptail(None)
+        return PersistentVector(self.count - 1, shift, root, tail)
+    
+    def extend(self, items):
+        """ Return copy of self with the values in items appended. The
+        nodes created are only copied once, like in
+        PersistentTreeMap.update. """
+        vec = self.volatile().extend(items)
+        return PersistentVector(vec.count, vec.shift, vec.root, vec.tail)
+    
+    @staticmethod
+    def from_iterable(items):
+        """ Create PersistentVector containing the values in items. """
+        return PersistentVector().extend(items)
+    
+    def volatile(self):
+        """ Return VolatileVector with the contents of self. This is O(1),
+        nodes are only copied once they are first modified through it. """
+        return VolatileVector(self.count, self.shift, self.root, self.tail)
+
+
+class VolatileVector(PersistentVector):
+    """ Vector that is modified in place, see VolatileTreeMap. """
+    _append = PersistentVector.append
+    _extend = PersistentVector.extend
+    _assoc = PersistentVector.assoc
+    _pop = PersistentVector.pop
+    
+    def __init__(self, count=0, shift=SHIFT, root=None, tail=None):
+        PersistentVector.__init__(self, count, shift, root, tail)
+        self.edit = object()
+        # The tail is modified in place, so it must not be shared.
+        self.tail = self.tail[:]
+    
+    def append(self, value):
+        """ Append value to this VolatileVector.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileVector may exist. """
+        edit = editing(self)
+        if len(self.tail) < BRANCH:
+            self.tail.append(value)
+        else:
+            self.shift, self.root = self._pushtail(edit)
+            self.tail = [value]
+        self.count += 1
+        return self
+    
+    def extend(self, items):
+        """ Append all values in items to this VolatileVector.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileVector may exist. """
+        editing(self)
+        for value in items:
+            self.append(value)
+        return self
+    
+    def assoc(self, idx, value):
+        """ Replace the value at index idx by value. If idx is the length of
+        this VolatileVector, value is appended.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileVector may exist. """
+        edit = editing(self)
+        if idx == self.count:
+            return self.append(value)
+        idx = self._index(idx)
+        if idx >= self.count - len(self.tail):
+            self.tail[idx & BMAP] = value
+        else:
+            self.root = self.root.assoc(self.shift, idx, value, edit)
+        return self
+    
+    def pop(self):
+        """ Remove the last value.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileVector may exist. """
+        edit = editing(self)
+        if not self.count:
+            raise IndexError('pop from empty vector')
+        if len(self.tail) > 1 or self.count == 1:
+            self.tail.pop()
+        else:
+            self.shift, self.root, self.tail = self._poptail(edit)
+        self.count -= 1
+        return self
+    
+    def persistent(self):
+        """ Make this vector persistent. Its nodes will not be modified in
+        place anymore, because the edit token they carry is dropped. """
+        self.append = self._append
+        self.extend = self._extend
+        self.assoc = self._assoc
+        self.pop = self._pop
+        self.edit = None
+        
+        return self
+
+
+# The maximal number of keys or children of a node of a PersistentSortedMap.
+# Nodes with fewer than MINSORTED are merged with one of their neighbours,
+# which keeps the tree balanced when keys are removed.
+MAXSORTED = 64
+MINSORTED = MAXSORTED // 4
+
+
+def spread(length, size):
+    """ Return (start, stop) pairs splitting range(length) into as few
+    parts of nearly equal length as possible that are at most size long. """
+    parts = -(-length // size)
+    return [
+        (length * part // parts, length * (part + 1) // parts)
+        for part in xrange(parts)
+    ]
+
+
+class SortedLeaf(object):
+    """ Leaf of a PersistentSortedMap, containing the sorted keys and their
+    values. """
+    __slots__ = ['keys', 'values', 'edit']
+    def __init__(self, keys, values, edit=None):
+        self.keys = keys
+        self.values = values
+        self.edit = edit
+    
+    @property
+    def size(self):
+        return len(self.keys)
+    
+    def __reduce__(self):
+        return SortedLeaf, (self.keys, self.values)
+    
+    def _editable(self, edit):
+        """ Return self if it is owned by edit, otherwise a copy of self
+        that is. Persistent operations pass None and always get a copy. """
+        if edit is not None and self.edit is edit:
+            return self
+        return SortedLeaf(self.keys[:], self.values[:], edit)
+    
+    def _split(self, edit):
+        """ Return the two halves of this node. """
+        half = len(self.keys) // 2
+        return [
+            SortedLeaf(self.keys[:half], self.values[:half], edit),
+            SortedLeaf(self.keys[half:], self.values[half:], edit),
+        ]
+    
+    def _merged(self, other, edit):
+        """ Return node containing the contents of self and of other, the
+        node following it. """
+        return SortedLeaf(
+            self.keys + other.keys, self.values + other.values, edit
+        )
+    
+    def assoc(self, key, value, edit):
+        """ Return a list of the node with key associated with value, or of
+        its two halves if it grew too large. """
+        new = self._editable(edit)
+        keys = new.keys
+        idx = bisect_left(keys, key)
+        if idx < len(keys) and keys[idx] == key:
+            new.values[idx] = value
+            return [new]
+        keys.insert(idx, key)
+        new.values.insert(idx, value)
+        if len(keys) > MAXSORTED:
+            return new._split(edit)
+        return [new]
+    
+    def without(self, key, edit):
+        """ Return the node without key, or raise KeyError if it does not
+        contain it. """
+        idx = bisect_left(self.keys, key)
+        if idx == len(self.keys) or self.keys[idx] != key:
+            raise KeyError(key)
+        new = self._editable(edit)
+        del new.keys[idx]
+        del new.values[idx]
+        return new
+
+
+class SortedBranch(object):
+    """ Inner node of a PersistentSortedMap. keys[n] is the smallest key in
+    the subtree children[n]. """
+    __slots__ = ['keys', 'children', 'edit', 'size']
+    def __init__(self, keys, children, edit=None, size=None):
+        if size is None:
+            size = sum(child.size for child in children)
+        
+        self.keys = keys
+        self.children = children
+        self.edit = edit
+        # The number of keys in the subtree.
+        self.size = size
+    
+    def __reduce__(self):
+        return SortedBranch, (self.keys, self.children, None, self.size)
+    
+    def _editable(self, edit):
+        """ Return self if it is owned by edit, otherwise a copy of self
+        that is. Persistent operations pass None and always get a copy. """
+        if edit is not None and self.edit is edit:
+            return self
+        return SortedBranch(self.keys[:], self.children[:], edit, self.size)
+    
+    def _split(self, edit):
+        """ Return the two halves of this node. """
+        half = len(self.keys) // 2
+        return [
+            SortedBranch(self.keys[:half], self.children[:half], edit),
+            SortedBranch(self.keys[half:], self.children[half:], edit),
+        ]
+    
+    def _merged(self, other, edit):
+        """ Return node containing the contents of self and of other, the
+        node following it. """
+        return SortedBranch(
+            self.keys + other.keys, self.children + other.children, edit,
+            self.size + other.size
+        )
+    
+    def assoc(self, key, value, edit):
+        """ Return a list of the node with key associated with value, or of
+        its two halves if it grew too large. """
+        idx = max(bisect_right(self.keys, key) - 1, 0)
+        child = self.children[idx]
+        # The child may be modified in place, so remember its size.
+        size = child.size
+        nodes = child.assoc(key, value, edit)
+        new = self._editable(edit)
+        new.children[idx:idx + 1] = nodes
+        new.keys[idx:idx + 1] = [node.keys[0] for node in nodes]
+        new.size += sum(node.size for node in nodes) - size
+        if len(new.children) > MAXSORTED:
+            return new._split(edit)
+        return [new]
+    
+    def without(self, key, edit):
+        """ Return the node without key, or raise KeyError if it does not
+        contain it. """
+        idx = max(bisect_right(self.keys, key) - 1, 0)
+        child = self.children[idx].without(key, edit)
+        new = self._editable(edit)
+        new.size -= 1
+        if len(child.keys) >= MINSORTED or len(new.children) == 1:
+            if child.keys:
+                new.children[idx] = child
+                new.keys[idx] = child.keys[0]
+            else:
+                # Only the child of a root that is about to be dropped can
+                # become empty without having a neighbour to merge with.
+                del new.children[idx]
+                del new.keys[idx]
+            return new
+        
+        if idx + 1 < len(new.children):
+            merged = child._merged(new.children[idx + 1], edit)
+        else:
+            idx -= 1
+            merged = new.children[idx]._merged(child, edit)
+        nodes = [merged]
+        if len(merged.keys) > MAXSORTED:
+            nodes = merged._split(edit)
+        new.children[idx:idx + 2] = nodes
+        new.keys[idx:idx + 2] = [node.keys[0] for node in nodes]
+        return new
+
+
+def sortedroot(nodes, edit=None):
+    """ Return the root of a PersistentSortedMap whose root was replaced
+    by nodes, the result of assoc or without. """
+    if len(nodes) > 1:
+        return SortedBranch([node.keys[0] for node in nodes], nodes, edit)
+    root = nodes[0]
+    while root.__class__ is SortedBranch and len(root.children) <= 1:
+        if not root.children:
+            return SortedLeaf([], [], edit)
+        root = root.children[0]
+    return root
+
+
+class PersistentSortedMap(object):
+    """ Map whose entries are ordered by their keys, which need to be
+    orderable with each other but not hashable. It is a persistent B+-tree
+    with up to MAXSORTED keys per node, so lookups, assoc and without are
+    O(log n) and range scans O(log n + k) for k entries. """
+    __slots__ = ['root']
+    def __init__(self, root=None):
+        if root is None:
+            root = SortedLeaf([], [])
+        self.root = root
+    
+    def __len__(self):
+        return self.root.size
+    
+    def __reduce__(self):
+        # VolatileSortedMaps are pickled as persistent ones.
+        return PersistentSortedMap, (self.root, )
+    
+    def _leaf(self, key):
+        """ Return the leaf that contains key if it is in self. """
+        node = self.root
+        while node.__class__ is SortedBranch:
+            node = node.children[max(bisect_right(node.keys, key) - 1, 0)]
+        return node
+    
+    def __getitem__(self, key):
+        leaf = self._leaf(key)
+        idx = bisect_left(leaf.keys, key)
+        if idx == len(leaf.keys) or leaf.keys[idx] != key:
+            raise KeyError(key)
+        return leaf.values[idx]
+    
+    def get(self, key, default=None):
+        """ Return the value of key, or default if self does not contain
+        it. """
+        leaf = self._leaf(key)
+        idx = bisect_left(leaf.keys, key)
+        if idx == len(leaf.keys) or leaf.keys[idx] != key:
+            return default
+        return leaf.values[idx]
+    
+    def __contains__(self, key):
+        leaf = self._leaf(key)
+        idx = bisect_left(leaf.keys, key)
+        return idx < len(leaf.keys) and leaf.keys[idx] == key
+    
+    def assoc(self, key, value):
+        """ Return copy of self with an association between key and value.
+        May override an existing association. """
+        return PersistentSortedMap(
+            sortedroot(self.root.assoc(key, value, None))
+        )
+    
+    def without(self, key):
+        """ Return copy of self with key removed. """
+        return PersistentSortedMap(sortedroot([self.root.without(key, None)]))
+    
+    def range(self, lo=None, hi=None):
+        """ Yield the (key, value) pairs of the keys from lo, inclusive, up
+        to hi, exclusive, in order. None stands for no limit. """
+        # The subtrees after the one lo is in come next. They are pushed in
+        # reverse so the first one is popped first.
+        stack = []
+        node = self.root
+        while node.__class__ is SortedBranch:
+            idx = 0
+            if lo is not None:
+                idx = max(bisect_right(node.keys, lo) - 1, 0)
+            stack.extend(reversed(node.children[idx + 1:]))
+            node = node.children[idx]
+        
+        start = 0 if lo is None else bisect_left(node.keys, lo)
+        while True:
+            keys = node.keys
+            stop = len(keys) if hi is None else bisect_left(keys, hi)
+            values = node.values
+            for idx in xrange(start, stop):
+                yield keys[idx], values[idx]
+            if stop < len(keys) or not stack:
+                return
+            node = stack.pop()
+            while node.__class__ is SortedBranch:
+                stack.extend(reversed(node.children[1:]))
+                node = node.children[0]
+            start = 0
+    
+    iteritems = range
+    
+    def __iter__(self):
+        return imap(itemgetter(0), self.range())
+    
+    iterkeys = __iter__
+    
+    def itervalues(self):
+        return imap(itemgetter(1), self.range())
+    
+    def first(self):
+        """ Return the (key, value) pair of the smallest key, or None if
+        self is empty. """
+        return next(self.range(), None)
+    
+    def last(self):
+        """ Return the (key, value) pair of the largest key, or None if
+        self is empty. """
+        node = self.root
+        while node.__class__ is SortedBranch:
+            node = node.children[-1]
+        if not node.keys:
+            return None
+        return node.keys[-1], node.values[-1]
+    
+    def ceiling(self, key):
+        """ Return the (key, value) pair of the smallest key that is
+        greater than or equal to key, or None if there is none. """
+        return next(self.range(key), None)
+    
+    def floor(self, key):
+        """ Return the (key, value) pair of the largest key that is less
+        than or equal to key, or None if there is none. """
+        node = self.root
+        while node.__class__ is SortedBranch:
+            # As keys are the smallest keys of the children, the child we
+            # end up in always contains a key that is small enough.
+            idx = bisect_right(node.keys, key) - 1
+            if idx < 0:
+                return None
+            node = node.children[idx]
+        idx = bisect_right(node.keys, key) - 1
+        if idx < 0:
+            return None
+        return node.keys[idx], node.values[idx]
+    
+    @staticmethod
+    def from_items(items):
+        """ Create PersistentSortedMap from an iterable of (key, value)
+        pairs. If a key occurs more than once, the last value wins. The
+        tree is built bottom-up from the sorted items, with nodes filled
+        to three quarters. """
+        keys = []
+        values = []
+        # The sort is stable, so the last value of a key comes last.
+        for key, value in sorted(items, key=itemgetter(0)):
+            if keys and keys[-1] == key:
+                values[-1] = value
+            else:
+                keys.append(key)
+                values.append(value)
+        if not keys:
+            return PersistentSortedMap()
+        
+        fill = MAXSORTED * 3 // 4
+        nodes = [
+            SortedLeaf(keys[start:stop], values[start:stop])
+            for start, stop in spread(len(keys), fill)
+        ]
+        while len(nodes) > 1:
+            nodes = [
+                SortedBranch(
+                    [node.keys[0] for node in nodes[start:stop]],
+                    nodes[start:stop]
+                ) for start, stop in spread(len(nodes), fill)
+            ]
+        return PersistentSortedMap(nodes[0])
+    
+    @staticmethod
+    def from_dict(dct):
+        """ Create PersistentSortedMap from existing dictionary. """
+        return PersistentSortedMap.from_items(dct.iteritems())
+    
+    def volatile(self):
+        """ Return VolatileSortedMap with the contents of self. This is
+        O(1), nodes are only copied once they are first modified through
+        it. """
+        return VolatileSortedMap(self.root)
+
+
+class VolatileSortedMap(PersistentSortedMap):
+    """ Sorted map that is modified in place, see VolatileTreeMap. """
+    _assoc = PersistentSortedMap.assoc
+    _without = PersistentSortedMap.without
+    
+    def __init__(self, root=None):
+        PersistentSortedMap.__init__(self, root)
+        self.edit = object()
+    
+    def assoc(self, key, value):
+        """ Update this VolatileSortedMap to contain an association between
         key and value.
         
         USE WITH CAUTION: This should only be used if no other reference
-        to the PersistentTreeMap may exist. """
-        self.root = self.root.assoc(hash(key), 0, SetNode(key))
+        to this VolatileSortedMap may exist. """
+        edit = editing(self)
+        self.root = sortedroot(self.root.assoc(key, value, edit), edit)
         return self
     
-    def without(self, key):
-        """ Remove key.
-        
-        USE WITH CAUTION: This should only be used if no other reference
-        to the PersistentTreeMap may exist. """
-        self.root = self.root._iwithout(hash(key), 0, key)
-        return self
+    def without(self, key):
+        """ Remove key.
+        
+        USE WITH CAUTION: This should only be used if no other reference
+        to this VolatileSortedMap may exist. """
+        edit = editing(self)
+        self.root = sortedroot([self.root.without(key, edit)], edit)
+        return self
+    
+    def persistent(self):
+        """ Make this map persistent. Its nodes will not be modified in
+        place anymore, because the edit token they carry is dropped. """
+        self.without = self._without
+        self.assoc = self._assoc
+        self.edit = None
+        
+        return self
+
+
+class Atom(object):
+    """ Reference to a value, usually a PersistentTreeMap, that many
+    threads can share. Readers get the current value with deref without
+    taking any lock; as the nodes of persistent maps are never modified,
+    the map they get is a consistent snapshot. Writers replace the value
+    with swap or compare_and_set, which only hold the lock for comparing
+    and replacing the reference, not while computing the new value. """
+    __slots__ = ['value', 'lock']
+    def __init__(self, value=None):
+        self.value = value
+        self.lock = threading.Lock()
+    
+    def deref(self):
+        """ Return the current value. """
+        return self.value
+    
+    def compare_and_set(self, old, new):
+        """ Replace the value by new if it still is old, which is compared
+        by identity. Return whether it was replaced. """
+        with self.lock:
+            if self.value is not old:
+                return False
+            self.value = new
+            return True
+    
+    def swap(self, fn, *args):
+        """ Replace the value by fn(value, *args) and return the new value.
+        If another thread replaced the value in the meantime, fn is called
+        again with the newer value, so it must not have side effects. """
+        while True:
+            old = self.value
+            new = fn(old, *args)
+            if self.compare_and_set(old, new):
+                return new
+    
+    def reset(self, value):
+        """ Replace the value by value regardless of the current one. """
+        with self.lock:
+            self.value = value
+
+
+def main():    
+    mp = PersistentTreeMap()
+    mp1 = mp.assoc('a', 'hello')
+    assert mp1['a'] == 'hello'
+    mp2 = mp1.assoc('b', 'world')
+    assert mp2['a'] == 'hello'
+    assert mp2['b'] == 'world'
+    mp3 = mp2.without('a')
+    assert len(mp) == 0 and len(mp1) == 1 and len(mp2) == 2 and len(mp3) == 1
+    assert mp3['b'] == 'world'
+    try:
+        assert mp3['a'] == 'hello'
+    except KeyError, e:
+        if e.args[0] != 'a':
+            assert False
+    else:
+        assert False
+    
+    assert set(mp2.iterkeys()) == set(mp2) == set(['a', 'b'])
+    assert set(mp2.itervalues()) == set(['hello', 'world'])
+    assert set(mp2.iteritems()) == set([('a', 'hello'), ('b', 'world')])
+    
+    assert [bit_count(n) for n in (0, 1, 0xff, 0xffffffff)] == [0, 1, 8, 32]
+    
+    # Small integers hash to themselves, so they fill up the nodes.
+    dense = PersistentTreeMap.from_items((n, n) for n in xrange(2048))
+    assert len(dense.root.items) == BRANCH
+    vol = PersistentTreeMap().volatile()
+    for n in xrange(2048):
+        assert vol.assoc(n, n) is vol
+    assert len(vol.root.items) == BRANCH
+    assert list(vol.diff(dense)) == []
+    assert (vol | dense).root is dense.root
+    for n in xrange(2048):
+        if n % 32 >= 4:
+            dense = dense.without(n)
+            vol.without(n)
+    assert len(dense.root.items) == len(vol.root.items) == 4
+    assert sorted(dense) == sorted(vol) == [
+        n for n in xrange(2048) if n % 32 < 4
+    ]
+    dense = dense.assoc(40, 'x')
+    assert dense[40] == 'x' and dense[33] == 33 and len(dense) == 257
+    
+    dct = dict((str(n), n) for n in xrange(5000))
+    mp = PersistentTreeMap.from_dict(dct)
+    assert dict(mp.iteritems()) == dct
+    mp = PersistentTreeMap.from_items(sorted(dct.iteritems()))
+    assert dict(mp.iteritems()) == dct
+    mp = PersistentTreeMap.from_items([('a', 1), ('b', 2), ('a', 3)])
+    assert dict(mp.iteritems()) == {'a': 3, 'b': 2}
+    # -1 and -2 share a hash, which exercises the collision handling.
+    mp = PersistentTreeMap.from_items([(-1, 'x'), (-2, 'y'), (-1, 'z')])
+    assert dict(mp.iteritems()) == {-1: 'z', -2: 'y'}
+    assert len(mp) == 2 and len(mp.without(-1)) == 1
+    assert mp.assoc(-2, 'w')[-2] == 'w'
+    assert len(list(mp.assoc(-2, 'w'))) == 2
+    
+    base = PersistentTreeMap.from_dict(dct)
+    vol = base.volatile()
+    for n in xrange(0, 5000, 2):
+        vol.assoc(str(n), -n)
+    for n in xrange(1, 5000, 4):
+        vol.without(str(n))
+    vol.assoc(-1, 'x').assoc(-2, 'y').assoc(-1, 'z').without(-2)
+    new = vol.persistent()
+    assert dict(base.iteritems()) == dct
+    expected = dict(dct)
+    for n in xrange(0, 5000, 2):
+        expected[str(n)] = -n
+    for n in xrange(1, 5000, 4):
+        del expected[str(n)]
+    expected[-1] = 'z'
+    assert dict(new.iteritems()) == expected
+    assert dict(new.assoc('a', 1).without('a').iteritems()) == expected
+    assert dict(new.iteritems()) == expected
+    assert len(new) == len(expected)
+    assert len(base) == len(dct)
+    
+    one = dict((n, 'one') for n in xrange(-500, 3000))
+    other = dict((n, 'other') for n in xrange(-2000, 1000, 3))
+    union = dict(one)
+    union.update(other)
+    mp = PersistentTreeMap.from_dict(one)
+    omp = PersistentTreeMap.from_dict(other)
+    assert dict((mp | omp).iteritems()) == union
+    assert dict((mp | PersistentTreeMap()).iteritems()) == one
+    assert dict((PersistentTreeMap() | omp).iteritems()) == other
+    assert (mp | mp).root is mp.root
+    changed = mp.assoc(5, 'five').assoc(-5000, 'new')
+    assert (mp | changed).root is changed.root
+    union = dict(one)
+    union[-5000] = 'new'
+    assert dict((changed | mp).iteritems()) == union
+    
+    assert dict((mp & omp).iteritems()) == dict(
+        (key, value) for key, value in one.iteritems() if key in other
+    )
+    assert dict((mp - omp).iteritems()) == dict(
+        (key, value) for key, value in one.iteritems() if key not in other
+    )
+    assert set((mp ^ omp).iteritems()) == (
+        set(one.iteritems()) | set(other.iteritems())
+    ) - set((key, one[key]) for key in other if key in one) - set(
+        (key, other[key]) for key in one if key in other)
+    assert (mp & mp).root is mp.root
+    assert (mp - mp).root is NULLNODE
+    assert (mp ^ mp).root is NULLNODE
+    assert (mp - PersistentTreeMap()).root is mp.root
+    assert dict((changed ^ mp).iteritems()) == {-5000: 'new'}
+    assert dict((changed - mp).iteritems()) == {-5000: 'new'}
+    assert dict((changed & mp).iteritems())[5] == 'five'
+    
+    assert list(mp.diff(mp)) == []
+    assert sorted(changed.diff(mp)) == [
+        (-5000, SENTINEL, 'new'), (5, 'one', 'five')
+    ]
+    assert sorted(mp.diff(changed)) == [
+        (-5000, 'new', SENTINEL), (5, 'five', 'one')
+    ]
+    assert list(mp.assoc(5, 'one').diff(mp)) == []
+    assert sorted(mp.diff(omp)) == sorted(
+        [(key, SENTINEL, 'one') for key in one if key not in other] +
+        [(key, 'other', SENTINEL) for key in other if key not in one] +
+        [(key, 'other', 'one') for key in one if key in other]
+    )
+    small = PersistentTreeMap().assoc(-1, 'x').assoc(-2, 'y')
+    assert sorted(small.diff(mp)) == sorted(
+        [(key, 'one', SENTINEL) for key in one if key not in (-1, -2)] +
+        [(-1, 'one', 'x'), (-2, 'one', 'y')]
+    )
+    assert sorted(small.assoc(3, 'z').diff(small)) == [(3, SENTINEL, 'z')]
+    assert sorted(small.without(-1).diff(small)) == [(-1, 'x', SENTINEL)]
+    
+    import tempfile
+    
+    for original in [mp, small, PersistentTreeMap(), small.without(-1)]:
+        copied = pickle.loads(pickle.dumps(original, 2))
+        assert type(copied) is PersistentTreeMap
+        assert dict(copied.iteritems()) == dict(original.iteritems())
+        assert len(copied) == len(original)
+        copied = pickle.loads(pickle.dumps(original, 0))
+        assert dict(copied.iteritems()) == dict(original.iteritems())
+        
+        with tempfile.NamedTemporaryFile() as fileobj:
+            original.dump(fileobj)
+            fileobj.flush()
+            loaded = PersistentTreeMap.load(fileobj.name)
+            assert len(loaded) == len(original)
+            for key, value in original.iteritems():
+                assert loaded[key] == value
+            assert dict(loaded.iteritems()) == dict(original.iteritems())
+            assert dict(loaded.assoc(-3, 'z').iteritems()) == dict(
+                original.assoc(-3, 'z').iteritems())
+            assert list(loaded.diff(original)) == []
+    assert pickle.loads(pickle.dumps(SENTINEL)) is SENTINEL
+    
+    st = PersistentTreeSet.from_set(set([-1, -2, 'a', 'b']))
+    assert set(pickle.loads(pickle.dumps(st))) == set(st)
+    with tempfile.NamedTemporaryFile() as fileobj:
+        st.dump(fileobj)
+        fileobj.flush()
+        assert set(PersistentTreeSet.load(fileobj.name)) == set(st)
+    
+    
+    for one, other in [
+        (set(xrange(1000)), set(xrange(500, 1500))),
+        (set([-1, -2, 5]), set(xrange(-3, 100))),
+        (set([-1, -2, 5]), set([-2, 7])),
+        (set([-1]), set(xrange(-3, 100))),
+        (set(), set(xrange(10))),
+    ]:
+        for one, other in [(one, other), (other, one)]:
+            st = PersistentTreeSet.from_set(one)
+            ost = PersistentTreeSet.from_set(other)
+            assert set(st | ost) == one | other
+            assert set(st & ost) == one & other
+            assert set(st - ost) == one - other
+            assert set(st ^ ost) == one ^ other
+            assert len(st | ost) == len(one | other)
+            assert len(st & ost) == len(one & other)
+            assert len(st - ost) == len(one - other)
+            assert len(st ^ ost) == len(one ^ other)
+            assert st.issubset(ost) == one.issubset(other)
+            assert st.isdisjoint(ost) == one.isdisjoint(other)
+            assert st.issubset(st | ost) and (st - ost).isdisjoint(ost)
+    
+    st = PersistentTreeSet.from_set([-1, -2, 'a', 'a', 5])
+    assert type(st) is PersistentTreeSet and sorted(st) == [-2, -1, 5, 'a']
+    added = st.add('b').add(-1)
+    assert type(added) is PersistentTreeSet and 'b' in added
+    assert len(added) == 5 and len(st) == 4 and 'b' not in st
+    removed = added.without(-1).without('a')
+    assert type(removed) is PersistentTreeSet
+    assert sorted(removed) == [-2, 5, 'b'] and sorted(added) == sorted(st) + [
+        'b']
+    assert sorted(st.update(xrange(3, 7))) == [-2, -1, 3, 4, 5, 6, 'a']
+    assert sorted(st.without_many([-1, -5, 'a'])) == [-2, 5]
+    vol = PersistentTreeSet().volatile()
+    for key in xrange(2000):
+        assert vol.add(key) is vol
+    # Only nodes owned by vol have been modified, so the root was created
+    # once and never copied again.
+    root = vol.root
+    assert vol.add(2000) is vol and vol.root is root
+    assert vol.update([-1, -2]).without_many([0, 1, -7]) is vol
+    assert sorted(vol) == [-2, -1] + range(2, 2001)
+    frozen = vol.persistent()
+    assert type(frozen.add(3000)) is PersistentTreeSet and 3000 not in frozen
+    
+    # Results sharing nodes with a volatile map or set do not change when
+    # it is modified afterwards.
+    base = PersistentTreeMap.from_items((n, n) for n in xrange(100))
+    cvol = base.volatile()
+    cvol.assoc(1000, 0)
+    derived = [
+        cvol & cvol, cvol | PersistentTreeMap(), PersistentTreeMap() | cvol,
+        cvol - base, cvol ^ PersistentTreeMap(), cvol.volatile(),
+        cvol.filter(lambda key, value: True), cvol.map_values(lambda v: v),
+        cvol.profiled(),
+    ]
+    cvol.assoc(1001, 1).without(5).assoc(1000, 2)
+    for result in derived:
+        assert 1001 not in result and result[1000] == 0
+    assert len(cvol) == 101 and cvol[1000] == 2
+    svol = PersistentTreeSet.from_set(xrange(100)).volatile()
+    svol.add(1000)
+    derived = [
+        svol & svol, svol | PersistentTreeSet(), PersistentTreeSet() | svol,
+        svol - PersistentTreeSet(), svol ^ PersistentTreeSet(),
+        svol.volatile(),
+    ]
+    svol.add(1001).without(5)
+    for result in derived:
+        assert 1001 not in result and 5 in result and 1000 in result
+    
+    # Methods bound before persistent() was called must not modify the
+    # map or set, nor its nodes, which may be shared by now.
+    base = PersistentTreeMap.from_items((n, n) for n in xrange(100))
+    cvol = base.volatile()
+    add, without, update = cvol.assoc, cvol.without, cvol.update
+    without_many = cvol.without_many
+    assoc_hashed, without_hashed = cvol.assoc_hashed, cvol.without_hashed
+    cvol.persistent()
+    hsh = hash(cvol)
+    for mutator in [
+        lambda: add('x', 1), lambda: without(5),
+        lambda: update([('x', 1)]), lambda: without_many([5]),
+        lambda: assoc_hashed('x', hash('x'), 1),
+        lambda: without_hashed(5, hash(5)),
+    ]:
+        try:
+            mutator()
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    assert len(base) == len(cvol) == 100 and 'x' not in base
+    assert hash(cvol) == hsh and cvol == base
+    sbase = PersistentTreeSet.from_set(xrange(100))
+    svol = sbase.volatile()
+    add, without, update = svol.add, svol.without, svol.update
+    without_many = svol.without_many
+    svol.persistent()
+    for mutator in [
+        lambda: add('x'), lambda: without(5), lambda: update(['x']),
+        lambda: without_many([5]),
+    ]:
+        try:
+            mutator()
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    assert len(sbase) == len(svol) == 100 and 'x' not in svol
+    
+    mp = PersistentTreeMap.from_items(
+        [(n, n) for n in xrange(-3, 3000)] +
+        [(str(n), n) for n in xrange(3000)]
+    )
+    entries = list(mp.cursor())
+    assert sorted(entries) == sorted(set(entries))
+    assert sorted((key, value) for _, key, value in entries) == sorted(
+        mp.iteritems())
+    assert [position for position, _, _ in entries] == sorted(
+        position for position, _, _ in entries)
+    for idx in [0, 1, 500, len(entries) - 1]:
+        assert list(mp.cursor(entries[idx][0])) == entries[idx + 1:]
+        # Resuming works even if the entry at start has been removed, as
+        # long as it is not in a HashCollisionNode.
+        assert list(mp.without(entries[idx][1]).cursor(entries[idx][0])) == (
+            entries[idx + 1:])
+    # Positions in a HashCollisionNode are indices, which are exact in the
+    # same version, and in versions in which the bucket is unchanged.
+    clash = [1000 + idx * (2 ** 64 - 1) for idx in xrange(20)]
+    bucketed = PersistentTreeMap.from_items(
+        [(key, idx) for idx, key in enumerate(clash)] +
+        [(n, n) for n in xrange(100)]
+    )
+    assert bucketed.root.find(hash(clash[0]), 0, clash[0]) is not NULLNODE
+    bucket = list(bucketed.cursor())
+    assert sorted(value for _, key, value in bucket if key in clash) == (
+        range(20))
+    for idx, (position, key, _) in enumerate(bucket):
+        assert list(bucketed.cursor(position)) == bucket[idx + 1:]
+        removed = (key + 1) % 100
+        assert list(bucketed.without(removed).cursor(position)) == [
+            entry for entry in bucket[idx + 1:] if entry[1] != removed]
+    pages = []
+    position = None
+    while True:
+        page, position = mp.page(1000, position)
+        pages.extend(page)
+        if position is None:
+            break
+    assert pages == [(key, value) for _, key, value in entries]
+    for n in [1, 2, 7, 32, 100, 10000]:
+        shards = mp.shards(n)
+        assert len(shards) == n
+        assert sum(
+            [list(mp.cursor(start, stop)) for start, stop in shards], []
+        ) == entries
+    assert PersistentTreeMap().page(10) == ([], None)
+    assert PersistentTreeMap().shards(3) == [
+        (None, (BRANCH, )), ((BRANCH, ), (BRANCH, )), ((BRANCH, ), None)
+    ]
+    assert mp.shards(1) == [(None, None)]
+    for method in (mp.page, mp.shards):
+        for count in (0, -1):
+            try:
+                method(count)
+            except ValueError:
+                pass
+            else:
+                assert False
+    
+    mp = PersistentTreeMap.from_items(
+        [(n, str(n)) for n in xrange(-3, 3000)] +
+        [(str(n), n) for n in xrange(3000)]
+    )
+    keys = [-1, -2, -3, -4, 'a', '5', 5, 2 ** 40, 40, 'x' * 100, None] + range(
+        -100, 5000, 7)
+    dct = dict(mp.iteritems())
+    changes = [(key, 'new') for key in keys[::2]]
+    updated = mp.update(changes)
+    assert type(updated) is PersistentTreeMap
+    assert dict(mp.iteritems()) == dct
+    expected = dict(dct)
+    expected.update(changes)
+    assert dict(updated.iteritems()) == expected
+    assert len(updated) == len(expected)
+    assert updated[-1] == 'new' and updated.update([]).root is updated.root
+    removed = updated.without_many(keys)
+    assert dict(updated.iteritems()) == expected
+    for key in keys:
+        expected.pop(key, None)
+    assert dict(removed.iteritems()) == expected
+    assert len(removed) == len(expected)
+    vol = mp.volatile()
+    assert vol.update(changes) is vol and vol.without_many([-1, -5]) is vol
+    assert -1 not in dict(vol.iteritems()) and vol[-3] == 'new'
+    new = vol.persistent()
+    assert new.update([(-3, 'newer')])[-3] == 'newer' and new[-3] == 'new'
+    assert len(new.without_many([-3])) == len(new) - 1 and new[-3] == 'new'
+    
+    for key in keys:
+        assert mp.get(key, 'missing') == dct.get(key, 'missing')
+        assert (key in mp) == (key in dct)
+    assert mp.get(-2) == '-2' and mp.get(-5) is None
+    assert small.without(-1).get(-1) is None and -2 in small.without(-1)
+    assert -1 not in PersistentTreeMap()
+    
+    # Longs whose difference is a multiple of 2 ** 64 - 1 share a hash on
+    # 64 bit platforms, but the test does not depend on it.
+    colliding = [5 + idx * (2 ** 64 - 1) for idx in xrange(50)]
+    coll = PersistentTreeMap()
+    cvol = PersistentTreeMap().volatile()
+    for idx, key in enumerate(colliding[::-1]):
+        coll = coll.assoc(key, idx)
+        cvol.assoc(key, idx)
+    # 5.0 equals 5 but cannot be found by bisection among the longs.
+    for key, value in [(5, 'five'), (5.0, 'float'), (colliding[-1], 'last')]:
+        coll = coll.assoc(key, value)
+        cvol.assoc(key, value)
+    expected = dict(
+        (key, idx) for idx, key in enumerate(colliding[::-1]))
+    expected[5] = 'float'
+    expected[colliding[-1]] = 'last'
+    for new in [
+        coll, PersistentTreeMap(cvol.root),
+        PersistentTreeMap.from_dict(expected),
+    ]:
+        assert dict(new.iteritems()) == expected and len(new) == 50
+        for key, value in expected.iteritems():
+            assert new[key] == new.get(key) == value
+        assert new.get(5 + 50 * (2 ** 64 - 1)) is None
+        assert new[5.0] == 'float'
+        probes = colliding + [5.0, 5 + 50 * (2 ** 64 - 1), 'x']
+        assert new.get_many(probes, 'missing') == [
+            new.get(key, 'missing') for key in probes]
+        assert dict(new.without(colliding[7]).iteritems()) == dict(
+            (key, value) for key, value in expected.iteritems()
+            if key != colliding[7])
+        assert dict(new.assoc('x', 1).iteritems()) == dict(expected, x=1)
+    for key in colliding[:45]:
+        cvol.without(key)
+        coll = coll.without(key)
+    assert sorted(coll) == sorted(cvol) == colliding[45:]
+    assert dict(pickle.loads(pickle.dumps(coll, 2)).iteritems()) == dict(
+        coll.iteritems())
+    
+    composite = [(n, frozenset([str(n)])) for n in xrange(200)] + [-1, -2]
+    hashed = PersistentTreeMap()
+    hvol = PersistentTreeMap().volatile()
+    for key in composite:
+        hashed = hashed.assoc_hashed(key, hash(key), key)
+        assert hvol.assoc_hashed(key, hash(key), key) is hvol
+    for new in [hashed, hvol]:
+        assert sorted(new) == sorted(composite)
+        for key in composite:
+            assert new.get_hashed(key, hash(key)) is new[key] is key
+        assert new.get_hashed('x', hash('x'), 0) == 0
+    assert hashed.without_hashed(-1, -2).get(-1) is None
+    assert len(hashed.without_hashed(-1, -2)) == len(composite) - 1
+    assert hvol.without_hashed(-2, -2) is hvol and -2 not in hvol
+    assert hvol.persistent().assoc_hashed(-2, -2, 1) is not hvol
+    
+    for n in [0, 1, 31, 32, 33, 64, 1024, 1056, 1057, 32 * 1024 + 33]:
+        lst = range(n)
+        vec = PersistentVector.from_iterable(lst)
+        assert len(vec) == n and list(vec) == lst
+        assert [vec[idx] for idx in xrange(0, n, 7)] == lst[::7]
+        if n:
+            assert vec[-1] == n - 1 and vec.assoc(-1, 'x')[n - 1] == 'x'
+        for idx in [n, -n - 1]:
+            try:
+                vec[idx]
+            except IndexError:
+                pass
+            else:
+                assert False
+        appended = vec.append('a').append('b')
+        assert list(appended) == lst + ['a', 'b'] and list(vec) == lst
+        changed = vec
+        for idx in xrange(0, n, 5):
+            changed = changed.assoc(idx, -idx)
+        expected = [-idx if idx % 5 == 0 else idx for idx in xrange(n)]
+        assert list(changed) == expected and list(vec) == lst
+        assert list(changed.volatile().extend('xy').persistent()) == (
+            expected + ['x', 'y'])
+        popped = vec
+        for idx in xrange(min(n, 100)):
+            popped = popped.pop()
+        assert list(popped) == lst[:n - min(n, 100)] and list(vec) == lst
+        if n < 2000:
+            popped = vec
+            while len(popped):
+                popped = popped.pop()
+                if len(popped) % 31 == 0:
+                    assert list(popped) == lst[:len(popped)]
+            assert list(popped.append(1)) == [1]
+        vol = vec.volatile()
+        for idx in xrange(0, n, 3):
+            assert vol.assoc(idx, 'v') is vol
+        vol.append('end').pop().append('last')
+        for _ in xrange(min(n, 40)):
+            assert vol.pop() is vol
+        expected = ['v' if idx % 3 == 0 else idx for idx in xrange(n)]
+        expected = (expected + ['last'])[:n + 1 - min(n, 40)]
+        assert list(vol) == expected and list(vec) == lst
+        assert list(vol.persistent().append(0)) == expected + [0]
+        assert list(vol) == expected
+        assert list(pickle.loads(pickle.dumps(changed, 2))) == list(changed)
+    try:
+        PersistentVector().pop()
+    except IndexError:
+        pass
+    else:
+        assert False
+    vec = PersistentVector()
+    for idx in xrange(2000):
+        vec = vec.assoc(idx, idx)
+    while len(vec) > 10:
+        vec = vec.pop()
+    assert list(vec) == range(10) and vec.shift == SHIFT
+    vol = vec.volatile()
+    append, assoc, pop, extend = vol.append, vol.assoc, vol.pop, vol.extend
+    vol.persistent()
+    for mutator in [
+        lambda: append(1), lambda: assoc(0, 'x'), lambda: pop(),
+        lambda: extend([1]),
+    ]:
+        try:
+            mutator()
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    assert list(vol) == list(vec) == range(10)
+    
+    import random
+    
+    rnd = random.Random(0)
+    for n in [0, 1, 63, 64, 65, 1000, 10000]:
+        sdct = dict((rnd.randrange(3 * n + 1), idx) for idx in xrange(n))
+        srt = PersistentSortedMap.from_dict(sdct)
+        skeys = sorted(sdct)
+        assert list(srt) == skeys and len(srt) == len(sdct)
+        assert list(srt.iteritems()) == sorted(sdct.iteritems())
+        assert list(srt.itervalues()) == [sdct[key] for key in skeys]
+        built = PersistentSortedMap()
+        svol = PersistentSortedMap().volatile()
+        for key, value in sdct.iteritems():
+            built = built.assoc(key, value)
+            assert svol.assoc(key, value) is svol
+        assert list(built.iteritems()) == list(svol.iteritems()) == (
+            sorted(sdct.iteritems()))
+        assert len(built) == len(svol) == len(sdct)
+        for probe in [-1, 0, n, 3 * n, 3 * n + 1] + [
+                rnd.randrange(-1, 3 * n + 2) for _ in xrange(50)]:
+            assert srt.get(probe) == sdct.get(probe)
+            assert (probe in srt) == (probe in sdct)
+            lower = [key for key in skeys if key <= probe]
+            upper = [key for key in skeys if key >= probe]
+            assert srt.floor(probe) == (
+                (lower[-1], sdct[lower[-1]]) if lower else None)
+            assert srt.ceiling(probe) == (
+                (upper[0], sdct[upper[0]]) if upper else None)
+            hi = probe + rnd.randrange(50)
+            assert list(srt.range(probe, hi)) == [
+                (key, sdct[key]) for key in skeys if probe <= key < hi]
+            assert [key for key, _ in srt.range(hi=probe)] == [
+                key for key in skeys if key < probe]
+        assert srt.first() == (
+            (skeys[0], sdct[skeys[0]]) if skeys else None)
+        assert srt.last() == (
+            (skeys[-1], sdct[skeys[-1]]) if skeys else None)
+        
+        removed = srt
+        for key in skeys[::2]:
+            removed = removed.without(key)
+            svol.without(key)
+        assert list(removed) == list(svol) == skeys[1::2]
+        assert len(removed) == len(svol) == len(skeys[1::2])
+        assert list(srt) == skeys
+        for key in skeys[1::2]:
+            removed = removed.without(key)
+            svol.without(key)
+        assert len(removed) == len(svol) == 0
+        assert removed.root.__class__ is svol.root.__class__ is SortedLeaf
+        try:
+            removed.without(0)
+        except KeyError:
+            pass
+        else:
+            assert False
+        assert list(svol.persistent().assoc(1, 2).iteritems()) == [(1, 2)]
+        assert len(svol) == 0
+        copied = pickle.loads(pickle.dumps(srt, 2))
+        assert list(copied.iteritems()) == list(srt.iteritems())
+    srt = PersistentSortedMap.from_items([('b', 1), ('a', 2), ('b', 3)])
+    assert list(srt.iteritems()) == [('a', 2), ('b', 3)]
+    svol = srt.volatile()
+    assoc, without = svol.assoc, svol.without
+    svol.persistent()
+    for mutator in [lambda: assoc('c', 1), lambda: without('a')]:
+        try:
+            mutator()
+        except RuntimeError:
+            pass
+        else:
+            assert False
+    assert list(svol.iteritems()) == [('a', 2), ('b', 3)]
+    
+    atom = Atom(PersistentTreeMap())
+    snapshot = atom.deref()
+    assert atom.compare_and_set(snapshot, snapshot.assoc('n', 0))
+    assert not atom.compare_and_set(snapshot, snapshot.assoc('n', 1))
+    assert atom.deref()['n'] == 0 and len(snapshot) == 0
+    
+    def increment(mp, key):
+        return mp.assoc(key, mp.get(key, 0) + 1)
+    
+    def incrementing():
+        for _ in xrange(500):
+            atom.swap(increment, 'n')
+            atom.swap(increment, threading.current_thread().name)
+    
+    workers = [threading.Thread(target=incrementing) for _ in xrange(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert atom.deref()['n'] == 2000 and len(atom.deref()) == 5
+    atom.reset(snapshot)
+    assert atom.deref() is snapshot
+    
+    # Small integers hash to themselves, so all keys end up on the third
+    # level below 1 + 32 + 1024 DispatchNodes.
+    stats = PersistentTreeMap.from_items((n, n) for n in xrange(2048)).stats()
+    assert stats['depths'] == {3: 2048} and stats['collisions'] == {}
+    assert stats['nodes'] == {'DispatchNode': 1057, 'AssocNode': 2048}
+    assert stats['fanout'] == (32 + 32 * 32 + 1024 * 2) / 1057.0
+    assert stats['bytes'] > 0
+    stats = coll.stats()
+    assert stats['depths'] == {0: 5} and stats['collisions'] == {5: 1}
+    assert PersistentTreeMap().stats()['nodes'] == {}
+    
+    profiled = PersistentTreeMap.from_items(
+        (n, n) for n in xrange(2048)).profiled()
+    # Setting 2048 needs a new leaf and copies of the three DispatchNodes
+    # above it, removing it only the copies.
+    profiled = profiled.assoc(2048, 'x').assoc(2048, 'y')
+    assert type(profiled) is ProfiledTreeMap and profiled[2048] == 'y'
+    profiled = profiled.without(2048)
+    assert profiled.get(5) == 5 and profiled.get(2048) is None
+    assert profiled.counters['assoc'] == Counter({4: 2})
+    assert profiled.counters['without'] == Counter({3: 1})
+    assert profiled.counters['get'] == Counter({4: 3})
+    # All lookups are counted, and derived maps keep counting.
+    assert 5 in profiled and profiled.get_hashed(5, hash(5)) == 5
+    assert profiled.get_many(iter([5, 6])) == [5, 6]
+    assert profiled.contains_many([7]) == [True]
+    assert profiled.counters['get'] == Counter({4: 8})
+    hsh = hash(profiled)
+    derived = [
+        profiled.assoc_hashed(1, hash(1), 'x'), profiled.without_hashed(1, 1),
+        profiled.update([(1, 'x')]), profiled.without_many([1]),
+        profiled & profiled, profiled | profiled, profiled - profiled,
+        profiled ^ profiled, profiled.filter(lambda key, value: True),
+        profiled.map_values(lambda value: value),
+        profiled.interned(NodeTable()),
+    ]
+    for new in derived:
+        assert type(new) is ProfiledTreeMap
+        assert new.counters is profiled.counters
+    assert derived[0].hashed is not None and derived[2] == derived[0]
+    assert hash(derived[2]) == hash(derived[0])
+    # Both single and batch changes copy the three DispatchNodes on the
+    # path and allocate the leaf.
+    assert profiled.counters['assoc'] == Counter({4: 3})
+    assert profiled.counters['without'] == Counter({3: 2})
+    assert profiled.counters['update'] == Counter({4: 1})
+    assert profiled.counters['without_many'] == Counter({3: 1})
+    # The batch copies the root once, the 32 nodes below it, the 64 below
+    # those, and allocates 64 leaves.
+    updated = profiled.update((n, 'x') for n in xrange(64))
+    assert updated.counters['update'][1 + 32 + 64 + 64] == 1
+    
+    table = NodeTable()
+    tenants = [
+        PersistentTreeMap.from_items((n, str(n)) for n in xrange(3000)),
+        PersistentTreeMap.from_items(
+            (n, str(n)) for n in xrange(2999, -1, -1)),
+    ]
+    assert tenants[0].root is not tenants[1].root
+    tenants = [tenant.interned(table) for tenant in tenants]
+    assert tenants[0].root is tenants[1].root and len(tenants[0]) == 3000
+    # Interning an interned map does not change it.
+    assert tenants[0].interned(table).root is tenants[0].root
+    changed = tenants[0].assoc(7, 'x').interned(table)
+    assert changed[7] == 'x' and tenants[0][7] == '7'
+    assert changed.assoc(7, '7').interned(table).root is tenants[0].root
+    # Only the new path was added to the table.
+    shared = [a for a, b in zip(changed.root.iterchildren(),
+                                tenants[0].root.iterchildren()) if a is b]
+    assert len(shared) == BRANCH - 1
+    # Values that are equal but of different types are not merged, and
+    # unhashable ones only with themselves.
+    pair = PersistentTreeMap().assoc(0, 0)
+    ints = pair.assoc(1, 1).interned(table)
+    assert type(pair.assoc(1, 1.0).interned(table)[1]) is float
+    assert pair.assoc(1, 1).interned(table).root is ints.root
+    lst = []
+    lists = pair.assoc(1, lst).interned(table)
+    assert pair.assoc(1, []).interned(table)[1] is not lst
+    assert pair.assoc(1, lst).interned(table).root is lists.root
+    # Leaves are shared along with the nodes containing them.
+    assert list(ints.root.iterchildren()) == list(
+        pair.assoc(1, 1).interned(table).root.iterchildren())
+    # Only the copies made by interning support weak references.
+    for node in [pair.root, ints.root, AssocNode(1, 1), SetNode(1)]:
+        try:
+            weakref.ref(node)
+        except TypeError:
+            assert node is not ints.root
+        else:
+            assert node is ints.root
+    assert ints.stats()['fanout'] == 2.0
+    assert pickle.loads(pickle.dumps(ints, 2)) == ints
+    # The bucket is sorted, so the order of insertion does not matter.
+    clash = [3 + idx * (2 ** 64 - 1) for idx in xrange(10)]
+    clashing = PersistentTreeMap.from_items(
+        (key, 0) for key in clash).interned(table)
+    assert PersistentTreeMap.from_items(
+        (key, 0) for key in clash[::-1]).interned(table).root is (
+        clashing.root)
+    interned = PersistentTreeSet.from_set(xrange(100)).interned(table)
+    assert interned.update([5]).interned(table).root is interned.root
+    # Nodes of a volatile map are copied, as they may still be modified.
+    cvol = PersistentTreeMap.from_items((n, n) for n in xrange(100)).volatile()
+    cvol.assoc(5, 'y')
+    frozen = cvol.interned(table)
+    cvol.assoc(5, 'x')
+    assert frozen.__class__ is PersistentTreeMap
+    assert frozen[5] == 'y' and cvol[5] == 'x'
+    # Unused nodes are dropped from the table.
+    size = len(table)
+    del tenants, changed, frozen, interned
+    assert len(table) < size
     
-    def persistent(self):
-        self.without = self._without
-        self.add = self._add
-        
-        return self
-
-
-def main():    
-    mp = PersistentTreeMap()
-    mp1 = mp.assoc('a', 'hello')
-    assert mp1['a'] == 'hello'
-    mp2 = mp1.assoc('b', 'world')
-    assert mp2['a'] == 'hello'
-    assert mp2['b'] == 'world'
-    mp3 = mp2.without('a')
-    assert mp3['b'] == 'world'
+    built = PersistentTreeMap.from_items((n, n) for n in xrange(3000))
+    looped = PersistentTreeMap()
+    for n in xrange(2999, -1, -1):
+        looped = looped.assoc(n, n)
+    assert built == looped and not built != looped
+    assert hash(built) == hash(looped) and {built: 'x'}[looped] == 'x'
+    changed = built.assoc(7, 'x')
+    assert changed != built and changed == looped.assoc(7, 'x')
+    assert changed.without(7) != built.without(8)
+    assert changed.without(7) == built.without(7)
+    assert built != PersistentTreeMap() and built != dict.fromkeys(built)
+    assert PersistentTreeMap().assoc(1, 1) == PersistentTreeMap().assoc(1, 1.0)
+    assert built != PersistentTreeSet.from_set(xrange(3000))
+    # New versions derive their hash from the cached one.
+    assert changed.hashed is not None
+    assert changed.hashed == sum(imap(entryhash, changed.root))
+    assert hash(changed.without(7)) == hash(looped.without(7))
+    assert changed.assoc(7, 7).hashed == built.hashed
+    assert hash(PersistentTreeMap()) == hash(PersistentTreeMap())
+    # Differently shaped trees with the same entries are equal.
+    assert built.filter(lambda key, value: key == 5) == (
+        PersistentTreeMap().assoc(5, 5))
+    assert PersistentTreeMap.from_items(
+        (key, 0) for key in clash[::-1]).without(clash[0]) == (
+        PersistentTreeMap.from_items((key, 0) for key in clash[1:]))
+    unhashable = built.assoc(8, [])
+    assert unhashable.hashed is None and unhashable == built.assoc(8, [])
     try:
-        assert mp3['a'] == 'hello'
-    except KeyError, e:
-        if e.args[0] != 'a':
-            assert False
+        hash(unhashable)
+    except TypeError:
+        pass
+    else:
+        assert False
+    cvol = built.volatile()
+    try:
+        hash(cvol)
+    except TypeError:
+        pass
+    else:
+        assert False
+    assert cvol == built
+    assert hash(cvol.assoc(7, 'x').persistent()) == hash(changed)
+    # Mutators bound before persistent() cannot invalidate the cached hash
+    # or make equal maps compare unequal.
+    cvol = built.volatile()
+    assoc = cvol.assoc
+    cvol.persistent()
+    hsh = hash(cvol)
+    try:
+        assoc(7, 'x')
+    except RuntimeError:
+        pass
+    assert cvol == built and hash(cvol) == hsh == hash(built)
+    assert cvol.hashed == sum(imap(entryhash, cvol.root))
+    st = PersistentTreeSet.from_set(xrange(1000))
+    ost = PersistentTreeSet()
+    for n in xrange(999, -1, -1):
+        ost = ost.add(n)
+    assert st == ost and hash(st) == hash(ost) and st != ost.without(5)
+    assert hash(st.add('x').without('x')) == hash(st)
+    assert st.add('x').hashed == st.hashed + hash('x')
+    try:
+        hash(st.volatile())
+    except TypeError:
+        pass
     else:
         assert False
     
-    assert set(mp2.iterkeys()) == set(mp2) == set(['a', 'b'])
-    assert set(mp2.itervalues()) == set(['hello', 'world'])
-    assert set(mp2.iteritems()) == set([('a', 'hello'), ('b', 'world')])
+    assert mp.get_many(keys, 'missing') == [
+        dct.get(key, 'missing') for key in keys]
+    assert mp.contains_many(keys) == [key in dct for key in keys]
+    # Iterators can only be consumed once.
+    assert mp.get_many(key for key in keys) == mp.get_many(keys)
+    assert mp.contains_many(iter(keys)) == [key in dct for key in keys]
+    assert PersistentTreeMap().get_many([1, 'a']) == [None, None]
+    assert small.without(-1).get_many([-1, -2]) == [None, 'y']
+    assert small.get_many([-1, -2, -3], 0) == ['x', 'y', 0]
+    with tempfile.NamedTemporaryFile() as fileobj:
+        mp.dump(fileobj)
+        fileobj.flush()
+        assert PersistentTreeMap.load(fileobj.name).get_many(keys, 0) == (
+            mp.get_many(keys, 0))
+    
+    import operator
+    
+    mp = PersistentTreeMap.from_items((n, n) for n in xrange(MINPARALLEL))
+    for workers in [1, 2]:
+        assert mp.map_values(abs, workers).root is mp.root
+        assert mp.filter(operator.le, workers).root is mp.root
+        assert mp.filter(operator.gt, workers).root is NULLNODE
+        new = mp.assoc(5, -5)
+        changed = new.map_values(abs, workers)
+        assert dict(changed.iteritems()) == dict(mp.iteritems())
+        assert len(changed) == len(mp)
+        assert sum(
+            a is not b for a, b in zip(
+                new.root.iterchildren(), changed.root.iterchildren())
+        ) == 1
+        assert dict(mp.map_values(heavy, workers).iteritems()) == dict(
+            (key, heavy(value)) for key, value in mp.iteritems())
+        assert dict(mp.filter(heavyeven, workers).iteritems()) == dict(
+            (key, value) for key, value in mp.iteritems()
+            if heavyeven(key, value))
+        assert mp.reduce(heavysum, 0, operator.add, workers) == (
+            mp.reduce(heavysum, 0))
+    assert len(mp.filter(heavyeven, 2)) == len(mp.filter(heavyeven))
+    small = PersistentTreeMap.from_items([(-1, 1), (-2, 2), (3, 3)])
+    assert dict(small.map_values(str, 2).iteritems()) == {
+        -1: '1', -2: '2', 3: '3'}
+    assert dict(small.filter(lambda key, value: value > 1).iteritems()) == {
+        -2: 2, 3: 3}
+    assert small.filter(lambda key, value: value > 3).root is NULLNODE
+    assert small.reduce(lambda acc, key, value: acc + value, 0) == 6
     
     import os
     import time
@@ -770,7 +4087,7 @@ def main():
     print 'PersistentHashMap:', time.time() - s
     assert mp[one] == other
     # This /may/ actually fail if we are unlucky, but it's a good start.
-    assert len(list(iter(mp))) == 225000
+    assert len(mp) == len(list(iter(mp))) == 225000
     
     #s = time.time()
     #dct = dict()
@@ -809,5 +4126,714 @@ def main():
         assert False
 
 
+def bench_from_items(n=200000):
+    """ Compare building a map with from_items against assoc'ing every
+    key into a VolatileTreeMap. """
+    import os
+    import time
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    
+    s = time.time()
+    mp = VolatileTreeMap()
+    for key, value in items:
+        mp = mp.assoc(key, value)
+    mp.persistent()
+    print 'VolatileTreeMap.assoc loop:', time.time() - s
+    
+    s = time.time()
+    PersistentTreeMap.from_items(items)
+    print 'PersistentTreeMap.from_items:', time.time() - s
+    
+    items.sort()
+    s = time.time()
+    PersistentTreeMap.from_items(items)
+    print 'PersistentTreeMap.from_items (sorted):', time.time() - s
+
+
+def bench_volatile(n=200000, batch=10000):
+    """ Compare applying a batch of updates to a large map through a
+    VolatileTreeMap against applying them one by one with assoc. """
+    import os
+    import time
+    
+    mp = PersistentTreeMap.from_items(
+        (os.urandom(20), os.urandom(25)) for _ in xrange(n)
+    )
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(batch)]
+    
+    s = time.time()
+    new = mp
+    for key, value in items:
+        new = new.assoc(key, value)
+    print 'PersistentTreeMap.assoc batch:', time.time() - s
+    
+    s = time.time()
+    new = mp.volatile()
+    for key, value in items:
+        new.assoc(key, value)
+    new.persistent()
+    print 'VolatileTreeMap batch:', time.time() - s
+
+
+def bench_union(n=200000, changes=100):
+    """ Compare the union of two versions of a large map with inserting
+    the nodes of one into the other one by one. """
+    import os
+    import time
+    
+    mp = PersistentTreeMap.from_items(
+        (os.urandom(20), os.urandom(25)) for _ in xrange(n)
+    )
+    other = mp.volatile()
+    for _ in xrange(changes):
+        other.assoc(os.urandom(20), os.urandom(25))
+    other = other.persistent()
+    
+    s = time.time()
+    new = mp.root
+    for node in other.root:
+        new = new.assoc(node.hsh, 0, node)
+    print 'Per-node union:', time.time() - s
+    
+    s = time.time()
+    mp | other
+    print 'PersistentTreeMap.__or__:', time.time() - s
+
+
+def bench_set_operations(n=200000, changes=100):
+    """ Compare the set operations on two versions of a large set with
+    computing them element by element. """
+    import os
+    import time
+    
+    st = PersistentTreeSet.from_set(set(os.urandom(20) for _ in xrange(n)))
+    other = st.volatile()
+    for _ in xrange(changes):
+        other.add(os.urandom(20))
+    other = other.persistent()
+    
+    s = time.time()
+    new = other
+    for key in st:
+        if key in other:
+            new = new.without(key)
+    print 'Per-element difference:', time.time() - s
+    
+    for name, operation in [
+        ('&', lambda a, b: a & b), ('-', lambda a, b: a - b),
+        ('^', lambda a, b: a ^ b)]:
+        s = time.time()
+        operation(other, st)
+        print 'PersistentTreeSet %s:' % name, time.time() - s
+
+
+def bench_load(n=200000, lookups=1000):
+    """ Compare loading a map written by dump and doing some lookups with
+    unpickling it and with rebuilding it from its items. """
+    import os
+    import time
+    import tempfile
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    mp = PersistentTreeMap.from_items(items)
+    keys = [key for key, value in items[:lookups]]
+    
+    s = time.time()
+    new = PersistentTreeMap.from_items(items)
+    for key in keys:
+        new[key]
+    print 'PersistentTreeMap.from_items and lookups:', time.time() - s
+    
+    data = pickle.dumps(mp, 2)
+    s = time.time()
+    new = pickle.loads(data)
+    for key in keys:
+        new[key]
+    print 'Unpickling and lookups:', time.time() - s
+    
+    with tempfile.NamedTemporaryFile() as fileobj:
+        mp.dump(fileobj)
+        fileobj.flush()
+        s = time.time()
+        new = PersistentTreeMap.load(fileobj.name)
+        for key in keys:
+            new[key]
+        print 'PersistentTreeMap.load and lookups:', time.time() - s
+
+
+def bench_lookup(n=200000):
+    """ Print the number of successful and failing lookups per second. """
+    import os
+    import time
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    mp = PersistentTreeMap.from_items(items)
+    
+    s = time.time()
+    for key, value in items:
+        mp[key]
+    print 'Lookups/sec (hits):', n / (time.time() - s)
+    
+    missing = [os.urandom(20) for _ in xrange(n)]
+    s = time.time()
+    for key in missing:
+        try:
+            mp[key]
+        except KeyError:
+            pass
+    print 'Lookups/sec (misses):', n / (time.time() - s)
+    
+    s = time.time()
+    for key in missing:
+        mp.get(key)
+    print 'Lookups/sec (misses, get):', n / (time.time() - s)
+    
+    s = time.time()
+    for key in missing:
+        key in mp
+    print 'Lookups/sec (misses, in):', n / (time.time() - s)
+    
+    st = PersistentTreeSet.from_set(set(key for key, value in items))
+    s = time.time()
+    for key in missing:
+        key in st
+    print 'Lookups/sec (misses, set):', n / (time.time() - s)
+
+
+def bench_iteration(n=500000):
+    """ Time full scans over a map. """
+    import os
+    import time
+    
+    mp = PersistentTreeMap.from_items(
+        (os.urandom(20), os.urandom(25)) for _ in xrange(n)
+    )
+    for name in ['iterkeys', 'itervalues', 'iteritems']:
+        s = time.time()
+        for _ in getattr(mp, name)():
+            pass
+        print 'PersistentTreeMap.%s:' % name, time.time() - s
+
+
+def bench_dispatch(n=200000):
+    """ Compare lookups and updates in maps whose DispatchNodes switch to
+    the dense layout once they become dense with maps that always use the
+    sparse one, for dense and for sparse keys. """
+    global MAXBITMAPDISPATCH
+    import os
+    import time
+    
+    default = MAXBITMAPDISPATCH
+    distributions = [
+        # Small integers hash to themselves, so they fill up the nodes.
+        ('dense', range(n)),
+        ('sparse', [os.urandom(20) for _ in xrange(n)]),
+    ]
+    for name, keys in distributions:
+        for limit in (default, BRANCH):
+            MAXBITMAPDISPATCH = limit
+            try:
+                kind = 'adaptive' if limit == default else 'sparse only'
+                mp = PersistentTreeMap.from_items((key, key) for key in keys)
+                
+                s = time.time()
+                for key in keys:
+                    mp[key]
+                print 'Lookups/sec (%s, %s):' % (name, kind), (
+                    n / (time.time() - s))
+                
+                s = time.time()
+                for key in keys[:n // 10]:
+                    mp = mp.assoc(key, None)
+                print 'Updates/sec (%s, %s):' % (name, kind), (
+                    n // 10 / (time.time() - s))
+            finally:
+                MAXBITMAPDISPATCH = default
+
+
+def bench_memory(n=200000):
+    """ Measure the memory used by the nodes of a map per entry, and the
+    lookups per second in it. """
+    import os
+    import time
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    mp = PersistentTreeMap.from_items(items)
+    
+    # The keys and values themselves are not counted.
+    print 'Bytes/entry:', float(mp.stats()['bytes']) / n
+    
+    s = time.time()
+    for key, value in items:
+        mp[key]
+    print 'Lookups/sec:', n / (time.time() - s)
+
+
+def bench_cursor(n=200000, count=1000):
+    """ Compare paging through a map by resuming a cursor with paging by
+    skipping the entries of the pages before, and scanning the shards. """
+    import os
+    import time
+    from itertools import islice
+    
+    mp = PersistentTreeMap.from_items(
+        (os.urandom(20), os.urandom(25)) for _ in xrange(n)
+    )
+    
+    s = time.time()
+    position = None
+    while True:
+        page, position = mp.page(count, position)
+        if position is None:
+            break
+    print 'Paging with positions:', time.time() - s
+    
+    s = time.time()
+    for offset in xrange(0, n, count):
+        list(islice(mp.iteritems(), offset, offset + count))
+    print 'Paging with offsets:', time.time() - s
+    
+    s = time.time()
+    for start, stop in mp.shards(8):
+        for _ in mp.cursor(start, stop):
+            pass
+    print 'Scanning 8 shards:', time.time() - s
+
+
+def heavy(value, rounds=100):
+    """ Return an expensive to compute function of value. This is used by
+    the parallel benchmarks, which need a picklable function. """
+    for _ in xrange(rounds):
+        value = hash((value, rounds))
+    return value
+
+
+def heavyeven(key, value):
+    """ Return whether heavy(value) is even. """
+    return heavy(value) % 2 == 0
+
+
+def heavysum(accumulator, key, value):
+    """ Add heavy(value) modulo 1000 to accumulator. """
+    return accumulator + heavy(value) % 1000
+
+
+def bench_parallel(n=200000):
+    """ Compare map_values, filter and reduce with different numbers of
+    worker processes. """
+    import multiprocessing
+    import operator
+    import time
+    
+    mp = PersistentTreeMap.from_items((n, n) for n in xrange(n))
+    counts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    print 'CPUs:', multiprocessing.cpu_count()
+    for workers in counts:
+        s = time.time()
+        mp.map_values(heavy, workers)
+        print 'map_values (%d workers):' % workers, time.time() - s
+        
+        s = time.time()
+        mp.filter(heavyeven, workers)
+        print 'filter (%d workers):' % workers, time.time() - s
+        
+        s = time.time()
+        mp.reduce(heavysum, 0, operator.add, workers)
+        print 'reduce (%d workers):' % workers, time.time() - s
+
+
+def bench_get_many(n=200000, batch=1000, repeat=100):
+    """ Compare get_many with looking up every key of a batch, of which
+    half are missing, with __getitem__. """
+    import os
+    import time
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    mp = PersistentTreeMap.from_items(items)
+    keys = [key for key, value in items[:batch // 2]] + [
+        os.urandom(20) for _ in xrange(batch // 2)
+    ]
+    
+    s = time.time()
+    for _ in xrange(repeat):
+        values = []
+        for key in keys:
+            try:
+                values.append(mp[key])
+            except KeyError:
+                values.append(None)
+    print 'Lookups/sec (__getitem__):', batch * repeat / (time.time() - s)
+    
+    s = time.time()
+    for _ in xrange(repeat):
+        mp.get_many(keys)
+    print 'Lookups/sec (get_many):', batch * repeat / (time.time() - s)
+    
+    s = time.time()
+    for _ in xrange(repeat):
+        mp.contains_many(keys)
+    print 'Lookups/sec (contains_many):', batch * repeat / (time.time() - s)
+
+
+def bench_update(n=200000, batches=(1000, 10000, 100000)):
+    """ Compare applying batches of changes with update and without_many
+    with calling assoc and without for every key. """
+    import os
+    import time
+    
+    items = [(os.urandom(20), os.urandom(25)) for _ in xrange(n)]
+    mp = PersistentTreeMap.from_items(items)
+    for batch in batches:
+        changes = [(key, None) for key, value in items[:batch // 2]] + [
+            (os.urandom(20), None) for _ in xrange(batch // 2)
+        ]
+        
+        s = time.time()
+        new = mp
+        for key, value in changes:
+            new = new.assoc(key, value)
+        print 'assoc (%d):' % batch, time.time() - s
+        
+        s = time.time()
+        mp.update(changes)
+        print 'update (%d):' % batch, time.time() - s
+        
+        s = time.time()
+        for key, value in changes:
+            new = new.without(key)
+        print 'without (%d):' % batch, time.time() - s
+        
+        s = time.time()
+        mp.without_many(key for key, value in changes)
+        print 'without_many (%d):' % batch, time.time() - s
+
+
+def bench_collisions(n=2000):
+    """ Compare inserting and looking up n keys with the same hash with
+    sorted and with linearly searched collision buckets. """
+    global MAXLINEARCOLLISION
+    import time
+    
+    default = MAXLINEARCOLLISION
+    # Longs whose difference is a multiple of 2 ** 64 - 1 share a hash on
+    # 64 bit platforms.
+    keys = [5 + idx * (2 ** 64 - 1) for idx in xrange(n)]
+    for limit in (default, n):
+        MAXLINEARCOLLISION = limit
+        kind = 'sorted' if limit == default else 'linear'
+        try:
+            s = time.time()
+            mp = PersistentTreeMap()
+            for key in keys:
+                mp = mp.assoc(key, key)
+            print 'Inserts/sec (%s):' % kind, n / (time.time() - s)
+            
+            s = time.time()
+            for key in keys:
+                mp[key]
+            print 'Lookups/sec (%s):' % kind, n / (time.time() - s)
+            
+            s = time.time()
+            mp.get_many(keys)
+            print 'Lookups/sec (%s, get_many):' % kind, n / (time.time() - s)
+        finally:
+            MAXLINEARCOLLISION = default
+
+
+def bench_hashed(n=100000):
+    """ Compare assoc and get with assoc_hashed and get_hashed for
+    composite keys whose hashes were computed once before. """
+    import time
+    
+    keys = [
+        (idx, tuple(xrange(idx, idx + 100)), str(idx)) for idx in xrange(n)
+    ]
+    pairs = zip(keys, map(hash, keys))
+    
+    s = time.time()
+    mp = PersistentTreeMap()
+    for key in keys:
+        mp = mp.assoc(key, None)
+    print 'assoc:', time.time() - s
+    
+    s = time.time()
+    mp = PersistentTreeMap()
+    for key, hsh in pairs:
+        mp = mp.assoc_hashed(key, hsh, None)
+    print 'assoc_hashed:', time.time() - s
+    
+    s = time.time()
+    for key in keys:
+        mp.get(key)
+    print 'get:', time.time() - s
+    
+    s = time.time()
+    for key, hsh in pairs:
+        mp.get_hashed(key, hsh)
+    print 'get_hashed:', time.time() - s
+
+
+def bench_atom(threads=4, readers=3, ops=20000):
+    """ Compare an Atom with a block.LockedResource holding a map that
+    threads read from and write to concurrently. Of every threads threads,
+    readers only look up keys and the others assoc them. """
+    import time
+    from block import LockedResource
+    
+    keys = range(1000)
+    initial = PersistentTreeMap.from_items((key, key) for key in keys)
+    
+    def atom_reader(atom):
+        for idx in xrange(ops):
+            atom.deref().get(keys[idx % 1000])
+    
+    def atom_writer(atom):
+        for idx in xrange(ops):
+            atom.swap(PersistentTreeMap.assoc, keys[idx % 1000], idx)
+    
+    def locked_reader(resource):
+        for idx in xrange(ops):
+            with resource as mp:
+                mp.get(keys[idx % 1000])
+    
+    def locked_writer(resource):
+        for idx in xrange(ops):
+            with resource:
+                resource.data = resource.data.assoc(keys[idx % 1000], idx)
+    
+    for name, shared, reader, writer in [
+        ('Atom', Atom(initial), atom_reader, atom_writer),
+        ('LockedResource', LockedResource(initial), locked_reader,
+         locked_writer),
+    ]:
+        workers = [
+            threading.Thread(
+                target=reader if idx < readers else writer, args=(shared, )
+            ) for idx in xrange(threads)
+        ]
+        s = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print 'Ops/sec (%s, %d readers, %d writers):' % (
+            name, readers, threads - readers), (
+            threads * ops / (time.time() - s))
+
+
+def bench_vector(n=20000):
+    """ Compare PersistentVector with copying a list for every change. """
+    import random
+    import time
+    
+    indices = [random.randrange(n) for _ in xrange(n)]
+    
+    s = time.time()
+    lst = []
+    for idx in xrange(n):
+        lst = lst + [idx]
+    print 'Appends/sec (list copy):', n / (time.time() - s)
+    
+    s = time.time()
+    vec = PersistentVector()
+    for idx in xrange(n):
+        vec = vec.append(idx)
+    print 'Appends/sec (PersistentVector):', n / (time.time() - s)
+    
+    s = time.time()
+    PersistentVector().extend(xrange(n))
+    print 'Appends/sec (PersistentVector.extend):', n / (time.time() - s)
+    
+    s = time.time()
+    for idx in indices:
+        lst = lst[:]
+        lst[idx] = None
+    print 'Updates/sec (list copy):', n / (time.time() - s)
+    
+    s = time.time()
+    for idx in indices:
+        vec = vec.assoc(idx, None)
+    print 'Updates/sec (PersistentVector):', n / (time.time() - s)
+    
+    s = time.time()
+    for idx in indices:
+        vec[idx]
+    print 'Lookups/sec (PersistentVector):', n / (time.time() - s)
+
+
+def bench_sorted(n=200000, queries=1000, k=100):
+    """ Compare range queries over a PersistentSortedMap with filtering a
+    PersistentTreeMap, and lookups and updates in both. """
+    import random
+    import time
+    
+    items = [(random.random(), idx) for idx in xrange(n)]
+    s = time.time()
+    srt = PersistentSortedMap.from_items(items)
+    print 'PersistentSortedMap.from_items:', time.time() - s
+    mp = PersistentTreeMap.from_items(items)
+    keys = sorted(key for key, value in items)
+    bounds = [
+        (keys[idx], keys[idx + k])
+        for idx in (random.randrange(n - k) for _ in xrange(queries))
+    ]
+    
+    s = time.time()
+    for lo, hi in bounds:
+        for _ in srt.range(lo, hi):
+            pass
+    print 'Range queries/sec (PersistentSortedMap):', (
+        queries / (time.time() - s))
+    
+    s = time.time()
+    for lo, hi in bounds[:10]:
+        for key, value in mp.iteritems():
+            if lo <= key < hi:
+                pass
+    print 'Range queries/sec (PersistentTreeMap):', 10 / (time.time() - s)
+    
+    for name, current in [
+        ('PersistentSortedMap', srt), ('PersistentTreeMap', mp)
+    ]:
+        s = time.time()
+        for key, value in items[:n // 10]:
+            current[key]
+        print 'Lookups/sec (%s):' % name, n // 10 / (time.time() - s)
+        
+        s = time.time()
+        for key, value in items[:n // 10]:
+            current = current.assoc(key, None)
+        print 'Updates/sec (%s):' % name, n // 10 / (time.time() - s)
+
+
+def bench_set_build(n=200000):
+    """ Compare the ways of building a PersistentTreeSet. """
+    import time
+    
+    keys = range(0, 3 * n, 3)
+    
+    s = time.time()
+    st = PersistentTreeSet()
+    for key in keys:
+        st = st.add(key)
+    print 'PersistentTreeSet.add:', time.time() - s
+    
+    s = time.time()
+    st = PersistentTreeSet().volatile()
+    for key in keys:
+        st.add(key)
+    st.persistent()
+    print 'VolatileTreeSet.add:', time.time() - s
+    
+    s = time.time()
+    PersistentTreeSet().update(keys)
+    print 'PersistentTreeSet.update:', time.time() - s
+    
+    s = time.time()
+    PersistentTreeSet.from_set(set(keys))
+    print 'PersistentTreeSet.from_set:', time.time() - s
+
+
+def bench_interning(n=20000, tenants=50, changes=10):
+    """ Measure the memory saved by interning maps that were built from
+    the same data with few changes. """
+    import time
+    import random
+    
+    base = dict((n, str(n)) for n in xrange(n))
+    rnd = random.Random(0)
+    maps = []
+    for _ in xrange(tenants):
+        dct = dict(base)
+        for _ in xrange(changes):
+            dct[rnd.randrange(n)] = 'changed'
+        maps.append(PersistentTreeMap.from_dict(dct))
+    
+    def footprint(maps):
+        seen = set()
+        nbytes = 0
+        stack = [mp.root for mp in maps]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen or node is NULLNODE:
+                continue
+            seen.add(id(node))
+            nbytes += sys.getsizeof(node)
+            if isinstance(node, DispatchNode):
+                nbytes += sys.getsizeof(node.items)
+                stack.extend(node.iterchildren())
+            elif isinstance(node, HashCollisionNode):
+                stack.extend(node.children)
+        return nbytes
+    
+    print 'Bytes without interning:', footprint(maps)
+    table = NodeTable()
+    s = time.time()
+    maps = [mp.interned(table) for mp in maps]
+    print 'Interning:', time.time() - s
+    print 'Bytes with interning:', footprint(maps)
+    s = time.time()
+    for mp in maps:
+        mp.assoc(0, 'new').interned(table)
+    print 'Interning new versions:', time.time() - s
+
+
+def bench_equality(n=200000, repeat=1000):
+    """ Compare two versions of a map that differ in one key. """
+    import time
+    
+    mp = PersistentTreeMap.from_items((n, n) for n in xrange(n))
+    other = mp.assoc(n // 2, 'x')
+    
+    s = time.time()
+    assert dict(mp.iteritems()) != dict(other.iteritems())
+    print 'dict:', time.time() - s
+    
+    s = time.time()
+    for _ in xrange(repeat):
+        assert mp != other
+    print 'PersistentTreeMap.__eq__:', (time.time() - s) / repeat
+    
+    s = time.time()
+    hash(mp)
+    print 'First hash:', time.time() - s
+    
+    s = time.time()
+    for n in xrange(repeat):
+        hash(mp.assoc(n, 'x'))
+    print 'Hash of new version:', (time.time() - s) / repeat
+
+
+def bench():
+    """ Run all benchmarks. """
+    bench_from_items()
+    bench_volatile()
+    bench_union()
+    bench_set_operations()
+    bench_load()
+    bench_lookup()
+    bench_iteration()
+    bench_dispatch()
+    bench_memory()
+    bench_cursor()
+    bench_parallel()
+    bench_get_many()
+    bench_update()
+    bench_collisions()
+    bench_hashed()
+    bench_atom()
+    bench_atom(readers=0)
+    bench_vector()
+    bench_sorted()
+    bench_set_build()
+    bench_interning()
+    bench_equality()
+
+
 if __name__ == '__main__':
-    main()
+    import sys
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        main()